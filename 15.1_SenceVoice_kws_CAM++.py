@@ -1,20 +1,18 @@
 import cv2
+import io
 import pyaudio
-import wave
 import threading
 import numpy as np
 import time
 from queue import Queue
 import webrtcvad
 import os
-import threading
 from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, AutoProcessor
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from qwen_vl_utils import process_vision_info
 import torch
 from funasr import AutoModel
 import pygame
-import edge_tts
 import asyncio
 from time import sleep
 import langid
@@ -24,9 +22,10 @@ from pypinyin import pinyin, Style
 from modelscope.pipelines import pipeline
 # 需提前安装: pip install modelscope
 from modelscope import snapshot_download
+from src.backend.tts_pipeline import SentenceTTSPipeline, edge_tts_bytes_synthesizer
+from src.backend.audio_utils import text_to_speech_bytes, save_wav_async
 
 # --- 配置huggingFace国内镜像 ---
-import os
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 
 # 参数设置
@@ -36,6 +35,7 @@ CHUNK = 1024              # 音频块大小
 VAD_MODE = 3              # VAD 模式 (0-3, 数字越大越敏感)
 OUTPUT_DIR = "./output"   # 输出目录
 NO_SPEECH_THRESHOLD = 1   # 无效语音阈值，单位：秒
+SAVE_AUDIO_ARCHIVE = False  # 是否在后台归档每段语音到 OUTPUT_DIR（推理全程走内存，不依赖该文件）
 folder_path = "./Test_QWen2_VL/"
 audio_file_count = 0
 audio_file_count_tmp = 0
@@ -195,7 +195,6 @@ def save_audio_video():
     else:
         audio_file_count += 1
         audio_output_path = f"{OUTPUT_DIR}/audio_{audio_file_count}.wav"
-    # audio_output_path = f"{OUTPUT_DIR}/audio_0.wav"
 
     if not segments_to_save:
         return
@@ -223,24 +222,23 @@ def save_audio_video():
             print("声纹注册语音需大于3秒，请重新注册")
             return 1
 
-    wf = wave.open(audio_output_path, 'wb')
-    wf.setnchannels(AUDIO_CHANNELS)
-    wf.setsampwidth(2)  # 16-bit PCM
-    wf.setframerate(AUDIO_RATE)
-    wf.writeframes(b''.join(audio_frames))
-    wf.close()
-    print(f"音频保存至 {audio_output_path}")
-
-    # Inference()
+    raw_audio = b''.join(audio_frames)
 
     if flag_sv_enroll:
+        # 声纹注册音频需要持久保存
+        save_wav_async(raw_audio, audio_output_path).join()
+        print(f"音频保存至 {audio_output_path}")
         text = "声纹注册完成！现在只有你可以命令我啦！"
         print(text)
         flag_sv_enroll = 0
         system_introduction(text)
     else:
+        # 归档可选且在后台写出，推理直接使用内存中的 PCM
+        if SAVE_AUDIO_ARCHIVE:
+            save_wav_async(raw_audio, audio_output_path)
+        audio_data = np.frombuffer(raw_audio, dtype=np.int16).astype(np.float32) / 32768.0
     # 使用线程执行推理
-        inference_thread = threading.Thread(target=Inference, args=(audio_output_path,))
+        inference_thread = threading.Thread(target=Inference, args=(audio_data,))
         inference_thread.start()
         
         # 记录保存的区间
@@ -250,25 +248,50 @@ def save_audio_video():
     segments_to_save.clear()
 
 # --- 播放音频 -
-def play_audio(file_path):
+def play_audio(audio_bytes):
     try:
         pygame.mixer.init()
-        pygame.mixer.music.load(file_path)
+        # 直接从内存加载 mp3，不经过磁盘
+        pygame.mixer.music.load(io.BytesIO(audio_bytes), "mp3")
         pygame.mixer.music.play()
         while pygame.mixer.music.get_busy():
-            time.sleep(1)  # 等待音频播放结束
+            time.sleep(0.05)  # 等待音频播放结束，轮询间隔短以减少句间停顿
         print("播放完成！")
     except Exception as e:
         print(f"播放失败: {e}")
     finally:
         pygame.mixer.quit()
 
-async def amain(TEXT, VOICE, OUTPUT_FILE) -> None:
-    """Main function"""
-    communicate = edge_tts.Communicate(TEXT, VOICE)
-    await communicate.save(OUTPUT_FILE)
+# --- 后台顺序播放：生成循环只负责入队，不被播放阻塞 -
+def start_playback():
+    playback_queue = Queue()
+
+    def worker():
+        while True:
+            audio_bytes = playback_queue.get()
+            if audio_bytes is None:
+                return
+            play_audio(audio_bytes)
+
+    playback_thread = threading.Thread(target=worker, daemon=True)
+    playback_thread.start()
+    return playback_queue, playback_thread
+
+# --- 后台生成：出错时结束 streamer，避免主循环永远等待下一个 token -
+def start_generate(model, tokenizer, model_inputs):
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+    def worker():
+        try:
+            model.generate(**model_inputs, max_new_tokens=512, streamer=streamer)
+        except Exception as e:
+            print(f"生成失败: {e}")
+            streamer.end()
+
+    generate_thread = threading.Thread(target=worker, daemon=True)
+    generate_thread.start()
+    return streamer, generate_thread
 
-import os
 
 def is_folder_empty(folder_path):
     """
@@ -351,10 +374,11 @@ def system_introduction(text):
     text = text
     print("LLM output:", text)
     used_speaker = "zh-CN-XiaoyiNeural"
-    asyncio.run(amain(text, used_speaker, os.path.join(folder_path,f"sft_tmp_{audio_file_count}.mp3")))
-    play_audio(f'{folder_path}/sft_tmp_{audio_file_count}.mp3')
+    audio_bytes = asyncio.run(text_to_speech_bytes(text, used_speaker))
+    if audio_bytes:
+        play_audio(audio_bytes)
 
-def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
+def Inference(audio_data=None):
     '''
     1. 使用senceVoice做asr，转换为拼音，检测唤醒词
         - 首先检测声纹注册文件夹是否有注册文件，如果无，启动声纹注册
@@ -383,9 +407,8 @@ def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
     
     else:
         # -------- SenceVoice 推理 ---------
-        input_file = (TEMP_AUDIO_FILE)
         res = model_senceVoice.generate(
-            input=input_file,
+            input=audio_data,
             cache={},
             language="auto", # "zn", "en", "yue", "ja", "ko", "nospeech"
             use_itn=False,
@@ -403,7 +426,7 @@ def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
         
         # --- KWS成功，或不设置KWS
         if flag_KWS:
-            sv_score = sv_pipeline([os.path.join(set_SV_enroll, "enroll_0.wav"), TEMP_AUDIO_FILE], thr=thred_sv)
+            sv_score = sv_pipeline([os.path.join(set_SV_enroll, "enroll_0.wav"), audio_data], thr=thred_sv)
             print(sv_score)
             sv_result = sv_score['text']
             if sv_result == "yes":
@@ -430,45 +453,31 @@ def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
                 )
                 model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
 
-                generated_ids = model.generate(
-                    **model_inputs,
-                    max_new_tokens=512,
-                )
-                generated_ids = [
-                    output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-                ]
-
-                output_text = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+                # 生成在后台线程进行，边生成边分句送入 TTS 队列
+                streamer, generate_thread = start_generate(model, tokenizer, model_inputs)
+
+                # 语种识别 -- langid，按回复首句选择音色，整段回复音色一致
+                tts_pipeline = SentenceTTSPipeline(edge_tts_bytes_synthesizer())
+                playback_queue, playback_thread = start_playback()
+                output_text = ""
+                for new_text in streamer:
+                    output_text += new_text
+                    tts_pipeline.feed(output_text)
+                    # 已合成好的句子按顺序交给播放线程
+                    for audio_chunk in tts_pipeline.ready_chunks():
+                        playback_queue.put(audio_chunk)
+                generate_thread.join()
 
                 print("answer", output_text)
 
                 # -------- 更新记忆库 -----
                 memory.add_to_history(prompt_tmp, output_text)
 
-                # 输入文本
-                text = output_text
-                # 语种识别 -- langid
-                language, confidence = langid.classify(text)
-                # 语种识别 -- langdetect 
-                # language = detect(text).split("-")[0]
-
-                language_speaker = {
-                "ja" : "ja-JP-NanamiNeural",            # ok
-                "fr" : "fr-FR-DeniseNeural",            # ok
-                "es" : "ca-ES-JoanaNeural",             # ok
-                "de" : "de-DE-KatjaNeural",             # ok
-                "zh" : "zh-CN-XiaoyiNeural",            # ok
-                "en" : "en-US-AnaNeural",               # ok
-                }
-
-                if language not in language_speaker.keys():
-                    used_speaker = "zh-CN-XiaoyiNeural"
-                else:
-                    used_speaker = language_speaker[language]
-                    print("检测到语种：", language, "使用音色：", language_speaker[language])
-
-                asyncio.run(amain(text, used_speaker, os.path.join(folder_path,f"sft_{audio_file_count}.mp3")))
-                play_audio(f'{folder_path}/sft_{audio_file_count}.mp3')
+                for audio_chunk in tts_pipeline.remaining_chunks():
+                    playback_queue.put(audio_chunk)
+                # 等待本轮播放完毕再开始下一轮
+                playback_queue.put(None)
+                playback_thread.join()
             else:
                 text = "很抱歉，声纹验证失败，我无法为您服务"
                 print(text)
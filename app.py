@@ -12,6 +12,7 @@ Maya Voice Assistant - Main Entry Point (WebLLM Style)
 
 import argparse
 from src.frontend.ui_webllm import create_webllm_ui
+from src.backend.config import MODEL_CONFIG
 
 def main():
     """主函数"""
@@ -74,9 +75,10 @@ def main():
     demo = create_webllm_ui()
 
     # 启用队列以支持流式输出和进度条
+    # 并发数与 LLM 调度器的批大小一致，并发请求在调度器中合批解码
     print("⚙️  配置队列系统...")
     demo.queue(
-        concurrency_count=5,
+        concurrency_count=MODEL_CONFIG["llm"]["max_batch_size"],
         max_size=20,
         api_open=False
     )
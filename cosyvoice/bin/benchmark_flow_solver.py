@@ -0,0 +1,122 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Quality/latency benchmark of the flow matching ODE solvers.
+
+The speech tokens of each text are decoded once, then the flow decoder is run
+with every solver and step count from the same noise. Quality is the mel L1
+distance to a reference solved with many euler steps, latency is the mean
+flow inference time.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.flow.flow_matching import ConditionalCFM
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark flow matching solvers')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M-SFT',
+                        help='local path')
+    parser.add_argument('--spk_id', type=str, default='中文女', help='sft speaker')
+    parser.add_argument('--text',
+                        type=str,
+                        nargs='+',
+                        default=['你好，很高兴认识你，今天天气不错。', '收到好友从远方寄来的生日礼物，那份意外的惊喜让我心中充满了甜蜜的快乐。'],
+                        help='texts to synthesize')
+    parser.add_argument('--solvers', type=str, nargs='+', default=list(ConditionalCFM.SOLVERS), help='solvers to compare')
+    parser.add_argument('--n_timesteps', type=int, nargs='+', default=[4, 6, 10], help='step counts to compare')
+    parser.add_argument('--reference_timesteps', type=int, default=50, help='euler steps of the reference mel')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per config')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def run_flow(model, model_input, speech_token, n_timesteps, solver, seed):
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    mel, _ = model.flow.inference(token=speech_token.to(model.device),
+                                  token_len=torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(model.device),
+                                  prompt_token=model_input['flow_prompt_speech_token'].to(model.device),
+                                  prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(model.device),
+                                  prompt_feat=model_input['prompt_speech_feat'].to(model.device),
+                                  prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(model.device),
+                                  embedding=model_input['flow_embedding'].to(model.device),
+                                  flow_cache=torch.zeros(1, 80, 0, 2),
+                                  n_timesteps=n_timesteps,
+                                  solver=solver)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mel.float(), time.time() - start_time
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
+    model = cosyvoice.model
+
+    # 1. decode speech tokens once, every solver sees the same tokens
+    cases = []
+    for text in args.text:
+        for i in cosyvoice.frontend.text_normalize(text, split=True):
+            model_input = cosyvoice.frontend.frontend_sft(i, args.spk_id)
+            tokens = list(model.llm.inference(text=model_input['text'].to(model.device),
+                                              text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(model.device),
+                                              prompt_text=torch.zeros(1, 0, dtype=torch.int32).to(model.device),
+                                              prompt_text_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                              prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32).to(model.device),
+                                              prompt_speech_token_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                              embedding=model_input['llm_embedding'].to(model.device)))
+            model_input.setdefault('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32))
+            model_input.setdefault('prompt_speech_feat', torch.zeros(1, 0, 80))
+            cases.append((model_input, torch.tensor(tokens).unsqueeze(dim=0)))
+
+    # 2. reference mel with many euler steps
+    references = [run_flow(model, model_input, speech_token, args.reference_timesteps, 'euler', seed)[0]
+                  for seed, (model_input, speech_token) in enumerate(cases)]
+
+    # 3. compare solvers
+    print('{:<10} {:>6} {:>5} {:>10} {:>12}'.format('solver', 'steps', 'nfe', 'mel_l1', 'latency_ms'))
+    for solver in args.solvers:
+        for n_timesteps in args.n_timesteps:
+            l1, latency = 0.0, 0.0
+            for seed, ((model_input, speech_token), reference) in enumerate(zip(cases, references)):
+                for _ in range(args.repeat):
+                    mel, elapsed = run_flow(model, model_input, speech_token, n_timesteps, solver, seed)
+                    latency += elapsed / args.repeat
+                l1 += (mel - reference).abs().mean().item()
+            nfe = n_timesteps * ConditionalCFM.SOLVERS[solver]
+            print('{:<10} {:>6} {:>5} {:>10.4f} {:>12.1f}'.format(solver, n_timesteps, nfe, l1 / len(cases), latency / len(cases) * 1000))
+
+
+if __name__ == "__main__":
+    main()
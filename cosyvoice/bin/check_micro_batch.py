@@ -0,0 +1,103 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check that micro-batched token2wav calls match their batch-1 results.
+
+Every row of a flow ODE batch is compared with the same row solved alone from
+the same noise. The vocoder draws its source noise per call, so its check
+feeds one fixed source to the batched and the batch-1 decode.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='check micro-batched flow and vocoder against batch-1 calls')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M-SFT',
+                        help='local path')
+    parser.add_argument('--batch_size', type=int, default=4, help='rows per batch')
+    parser.add_argument('--mel_len', type=int, default=200, help='mel frames of every row')
+    parser.add_argument('--n_timesteps', type=int, default=10, help='ode steps')
+    parser.add_argument('--solver', type=str, default='euler', help='ode solver')
+    parser.add_argument('--atol', type=float, default=1e-3, help='max abs difference allowed')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+@torch.inference_mode()
+def check_flow(model, args):
+    device = model.device
+    items = []
+    for _ in range(args.batch_size):
+        items.append((torch.randn(1, 80, args.mel_len, device=device),
+                      torch.randn(1, 80, args.mel_len, device=device),
+                      torch.ones(1, 1, args.mel_len, device=device),
+                      torch.randn(1, 80, device=device),
+                      torch.randn(1, 80, args.mel_len, device=device)))
+    batched = model._flow_solve_batch((args.mel_len, args.n_timesteps, args.solver), items)
+    diff = 0.0
+    for (z, mu, mask, spks, cond), feat in zip(items, batched):
+        single = model.flow.decoder.solve(z, mu, mask, args.n_timesteps, spks, cond, args.solver)
+        diff = max(diff, (feat - single).abs().max().item())
+    return diff
+
+
+@torch.inference_mode()
+def check_hift(model, args):
+    hift = model.hift
+    speech_feat = torch.randn(args.batch_size, 80, args.mel_len, device=model.device)
+    f0 = hift.f0_predictor(speech_feat)
+    s = hift.f0_upsamp(f0[:, None]).transpose(1, 2)
+    s, _, _ = hift.m_source(s)
+    s = s.transpose(1, 2)
+    batched = hift.decode(x=speech_feat, s=s)
+    diff = 0.0
+    for i in range(args.batch_size):
+        single = hift.decode(x=speech_feat[i:i + 1], s=s[i:i + 1])
+        diff = max(diff, (batched[i:i + 1] - single).abs().max().item())
+    return diff
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
+    model = cosyvoice.model
+
+    failed = False
+    for name, check in (('flow', check_flow), ('hift', check_hift)):
+        diff = check(model, args)
+        ok = diff <= args.atol
+        failed = failed or not ok
+        print('{:<5} max_abs_diff {:.3e} {}'.format(name, diff, 'ok' if ok else 'FAILED'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
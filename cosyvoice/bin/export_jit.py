@@ -65,7 +65,7 @@ def main():
     # 3. export flow encoder
     flow_encoder = cosyvoice.model.flow.encoder
     script = torch.jit.script(flow_encoder)
-    script = torch.jit.freeze(script)
+    script = torch.jit.freeze(script, preserved_attrs=['forward_chunk'])
     script = torch.jit.optimize_for_inference(script)
     script.save('{}/flow.encoder.fp32.zip'.format(args.model_dir))
 
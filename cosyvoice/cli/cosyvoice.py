@@ -23,21 +23,30 @@ from cosyvoice.utils.file_utils import logging
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True):
+    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True, prompt_cache_dir=None, user_spk2info=None,
+                 stream_prompt_cache=False, llm_max_batch_size=8, token2wav_max_batch_size=8, token2wav_max_wait=0.005,
+                 intra_op_num_threads=None, inter_op_num_threads=1):
         instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         with open('{}/cosyvoice.yaml'.format(model_dir), 'r') as f:
             configs = load_hyperpyyaml(f)
+        self.sample_rate = configs['sample_rate']
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
                                           instruct,
-                                          configs['allowed_special'])
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+                                          configs['allowed_special'],
+                                          user_spk2info if user_spk2info is not None else '{}/spk2info.user.pt'.format(model_dir),
+                                          prompt_cache_dir=prompt_cache_dir)
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16,
+                                    stream_prompt_cache=stream_prompt_cache,
+                                    llm_max_batch_size=llm_max_batch_size,
+                                    token2wav_max_batch_size=token2wav_max_batch_size,
+                                    token2wav_max_wait=token2wav_max_wait)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
@@ -46,50 +55,59 @@ class CosyVoice:
                                 '{}/llm.llm.fp16.zip'.format(model_dir),
                                 '{}/flow.encoder.fp32.zip'.format(model_dir))
         if load_onnx:
-            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir))
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                 intra_op_num_threads=intra_op_num_threads,
+                                 inter_op_num_threads=inter_op_num_threads)
         del configs
 
     def list_avaliable_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0):
+    def add_zero_shot_spk(self, prompt_text, prompt_speech_16k, spk_id, save=True, overwrite=False):
+        """Register a zero-shot prompt as a reusable speaker, inference_sft(tts_text, spk_id) then skips prompt processing"""
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False)
+        self.frontend.add_zero_shot_spk(prompt_text, prompt_speech_16k, spk_id, overwrite=overwrite)
+        if save is True:
+            self.frontend.save_spkinfo()
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, n_timesteps=10, solver='euler'):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
             model_input = self.frontend.frontend_sft(i, spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver='euler'):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False)
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
             model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver='euler'):
         if self.frontend.instruct is True:
             raise ValueError('{} do not support cross_lingual inference'.format(self.model_dir))
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
             model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, n_timesteps=10, solver='euler'):
         if self.frontend.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False)
@@ -97,17 +115,17 @@ class CosyVoice:
             model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, n_timesteps=10, solver='euler'):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k)
         start_time = time.time()
-        for model_output in self.model.vc(**model_input, stream=stream, speed=speed):
-            speech_len = model_output['tts_speech'].shape[1] / 22050
+        for model_output in self.model.vc(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver):
+            speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
             start_time = time.time()
@@ -21,6 +21,8 @@ import torchaudio.compliance.kaldi as kaldi
 import torchaudio
 import os
 import re
+import tempfile
+import threading
 import inflect
 try:
     import ttsfrd
@@ -31,6 +33,8 @@ except ImportError:
     from tn.english.normalizer import Normalizer as EnNormalizer
     use_ttsfrd = False
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph
+from cosyvoice.utils.prompt_cache import PromptFeatureCache, hash_prompt
+from cosyvoice.utils.file_utils import logging
 
 
 class CosyVoiceFrontEnd:
@@ -42,7 +46,10 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  instruct: bool = False,
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 user_spk2info: str = '',
+                 prompt_cache_max_bytes: int = 256 * 1024 * 1024,
+                 prompt_cache_dir: str = None):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -57,8 +64,21 @@ class CosyVoiceFrontEnd:
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
+        # speakers registered by add_zero_shot_spk live in their own file, the model's spk2info is never rewritten
+        self.user_spk2info_path = user_spk2info
+        self.user_spk_ids = set()
+        if user_spk2info and os.path.exists(user_spk2info):
+            for spk_id, spk_info in torch.load(user_spk2info, map_location=self.device).items():
+                if spk_id in self.spk2info:
+                    logging.warning('registered speaker {} shadows a built-in speaker, ignored'.format(spk_id))
+                    continue
+                self.spk2info[spk_id] = spk_info
+                self.user_spk_ids.add(spk_id)
+        self.spk2info_lock = threading.Lock()
         self.instruct = instruct
         self.allowed_special = allowed_special
+        # repeated zero-shot/vc prompts skip resampling, feature, token and embedding extraction
+        self.prompt_cache = PromptFeatureCache(prompt_cache_max_bytes, prompt_cache_dir, self.device)
         self.inflect_parser = inflect.engine()
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
@@ -108,6 +128,29 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _extract_prompt_text_token(self, prompt_text):
+        key = 'text_' + hash_prompt(prompt_text)
+        entry = self.prompt_cache.get(key)
+        if entry is None:
+            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+            entry = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len}
+            self.prompt_cache.put(key, entry)
+        return entry['prompt_text'], entry['prompt_text_len']
+
+    def _extract_prompt_speech(self, prompt_speech_16k):
+        key = 'speech_' + hash_prompt(prompt_speech_16k)
+        entry = self.prompt_cache.get(key)
+        if entry is None:
+            prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
+            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
+            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+            embedding = self._extract_spk_embedding(prompt_speech_16k)
+            entry = {'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                     'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                     'embedding': embedding}
+            self.prompt_cache.put(key, entry)
+        return entry
+
     def text_normalize(self, text, split=True):
         text = text.strip()
         if contains_chinese(text):
@@ -136,19 +179,68 @@ class CosyVoiceFrontEnd:
             return text
         return texts
 
+    def add_zero_shot_spk(self, prompt_text, prompt_speech_16k, spk_id, overwrite=False):
+        """Register a zero-shot prompt as speaker spk_id, later requests use it like a built-in sft speaker
+
+        Built-in speakers are never replaced, a registered speaker only when overwrite is True.
+        """
+        with self.spk2info_lock:
+            self._check_spk_id(spk_id, overwrite)
+        prompt_text_token, prompt_text_token_len = self._extract_prompt_text_token(prompt_text)
+        prompt = self._extract_prompt_speech(prompt_speech_16k)
+        spk_info = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                    'llm_prompt_speech_token': prompt['speech_token'], 'llm_prompt_speech_token_len': prompt['speech_token_len'],
+                    'flow_prompt_speech_token': prompt['speech_token'], 'flow_prompt_speech_token_len': prompt['speech_token_len'],
+                    'prompt_speech_feat': prompt['speech_feat'], 'prompt_speech_feat_len': prompt['speech_feat_len'],
+                    'embedding': prompt['embedding']}
+        with self.spk2info_lock:
+            # checked again, another request may have registered the same id during extraction
+            self._check_spk_id(spk_id, overwrite)
+            self.spk2info[spk_id] = spk_info
+            self.user_spk_ids.add(spk_id)
+
+    def _check_spk_id(self, spk_id, overwrite):
+        if spk_id in self.spk2info and spk_id not in self.user_spk_ids:
+            raise ValueError('spk_id {} is a built-in speaker'.format(spk_id))
+        if spk_id in self.user_spk_ids and overwrite is False:
+            raise ValueError('spk_id {} is already registered, set overwrite=True to replace it'.format(spk_id))
+
+    def save_spkinfo(self, path=None):
+        """Persist the speakers registered by add_zero_shot_spk, defaults to user_spk2info"""
+        path = path if path is not None else self.user_spk2info_path
+        assert path, 'no file to save registered speakers to, pass user_spk2info or path'
+        # write a unique temp file then rename, all under the lock so concurrent saves never interleave
+        # and a crash while saving never corrupts the speaker file
+        with self.spk2info_lock:
+            spk2info = {spk_id: {k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in self.spk2info[spk_id].items()}
+                        for spk_id in self.user_spk_ids}
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    torch.save(spk2info, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        embedding = self.spk2info[spk_id]['embedding']
+        spk_info = self.spk2info[spk_id]
+        embedding = spk_info['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        # speakers registered by add_zero_shot_spk also carry their prompt
+        for k, v in spk_info.items():
+            if k != 'embedding':
+                model_input[k] = v
         return model_input
 
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt_text_token, prompt_text_token_len = self._extract_prompt_text_token(prompt_text)
+        prompt = self._extract_prompt_speech(prompt_speech_16k)
+        speech_feat, speech_feat_len = prompt['speech_feat'], prompt['speech_feat_len']
+        speech_token, speech_token_len = prompt['speech_token'], prompt['speech_token_len']
+        embedding = prompt['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
                        'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                        'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
@@ -170,16 +262,19 @@ class CosyVoiceFrontEnd:
         model_input = self.frontend_sft(tts_text, spk_id)
         # in instruct mode, we remove spk_embedding in llm due to information leakage
         del model_input['llm_embedding']
+        # the instruct text replaces the prompt of a registered zero-shot speaker in llm
+        model_input.pop('llm_prompt_speech_token', None)
+        model_input.pop('llm_prompt_speech_token_len', None)
         instruct_text_token, instruct_text_token_len = self._extract_text_token(instruct_text + '<endofprompt>')
         model_input['prompt_text'] = instruct_text_token
         model_input['prompt_text_len'] = instruct_text_token_len
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = self._extract_prompt_speech(prompt_speech_16k)
+        prompt_speech_token, prompt_speech_token_len = prompt['speech_token'], prompt['speech_token_len']
+        prompt_speech_feat, prompt_speech_feat_len = prompt['speech_feat'], prompt['speech_feat_len']
+        embedding = prompt['embedding']
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
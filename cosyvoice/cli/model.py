@@ -12,13 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import torch
-import numpy as np
 import threading
-import time
 from torch.nn import functional as F
-from contextlib import nullcontext
+from contextlib import nullcontext, contextmanager
 import uuid
+from cosyvoice.hifigan.streaming import HiFTStream
+from cosyvoice.llm.batch_decoder import BatchSpeechTokenDecoder
 from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.micro_batch import MicroBatcher
+
+
+class TTSSession:
+    """State of one tts/vc request, released as soon as the request finishes, fails or is cancelled"""
+    __slots__ = ('uuid', 'speech_tokens', 'llm_end', 'mel_overlap', 'flow_cache', 'flow_prompt_cache', 'hift_cache', 'hift_stream',
+                 'cond', 'released')
+
+    def __init__(self, speech_tokens=None, llm_end=False):
+        self.uuid = str(uuid.uuid1())
+        self.speech_tokens = speech_tokens if speech_tokens is not None else []
+        self.llm_end = llm_end
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        # prompt encoder output and speaker projection, computed on the first streaming chunk
+        self.flow_prompt_cache = None
+        self.hift_cache = None
+        # streaming vocoder state, used instead of hift_cache when the vocoder supports it
+        self.hift_stream = None
+        # llm_job notifies the consumer as soon as new tokens arrive
+        self.cond = threading.Condition()
+        self.released = False
+
+    def nbytes(self):
+        tensors = [self.mel_overlap, self.flow_cache]
+        if self.flow_prompt_cache is not None:
+            tensors.extend(self.flow_prompt_cache.values())
+        if self.hift_cache is not None:
+            tensors.extend(self.hift_cache.values())
+        hift_stream_bytes = self.hift_stream.nbytes() if self.hift_stream is not None else 0
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None) + hift_stream_bytes
+
+    def release(self):
+        with self.cond:
+            self.released = True
+            self.llm_end = True
+            self.speech_tokens = []
+            self.mel_overlap, self.flow_cache, self.flow_prompt_cache, self.hift_cache = None, None, None, None
+            self.hift_stream = None
+            self.cond.notify_all()
 
 
 class CosyVoiceModel:
@@ -27,7 +67,11 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool):
+                 fp16: bool,
+                 stream_prompt_cache: bool = False,
+                 llm_max_batch_size: int = 8,
+                 token2wav_max_batch_size: int = 8,
+                 token2wav_max_wait: float = 0.005):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
@@ -38,23 +82,33 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        # windows live on device, same values as np.hamming
+        self.mel_window = torch.hamming_window(2 * self.mel_overlap_len, periodic=False, device=self.device)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        # chunked vocoder carrying conv and overlap-add state, otherwise hift cache and speech fade in out
+        self.hift_streaming = HiFTStream.supported(self.hift)
+        # streaming chunks reuse one prompt encoding per session instead of encoding prompt and chunk jointly,
+        # faster but the prompt encoding no longer sees the chunk tokens so the output drifts, off by default
+        self.stream_prompt_cache = stream_prompt_cache
+        self.speech_window = torch.hamming_window(2 * self.source_cache_len, periodic=False, device=self.device)
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        # concurrent requests share one batched decode loop, it owns llm_context, size it to the expected concurrency
+        self.llm_max_batch_size = llm_max_batch_size
+        self.llm_batch_decoder = BatchSpeechTokenDecoder(self.llm, max_batch_size=self.llm_max_batch_size, context=self.llm_context)
+        # flow ode and vocoder calls of concurrent sessions with the same mel length run as one batch,
+        # waiting at most max_wait seconds for peers
+        self.token2wav_max_batch_size = token2wav_max_batch_size
+        self.token2wav_max_wait = token2wav_max_wait
+        self.flow_batcher = MicroBatcher(self._flow_solve_batch, self.token2wav_max_batch_size, self.token2wav_max_wait)
+        self.hift_batcher = MicroBatcher(self._hift_inference_batch, self.token2wav_max_batch_size, self.token2wav_max_wait)
         self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # live sessions, keyed by uuid
+        self.sessions = {}
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=False)
@@ -77,30 +131,106 @@ class CosyVoiceModel:
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
-    def load_onnx(self, flow_decoder_estimator_model):
+    def load_onnx(self, flow_decoder_estimator_model, intra_op_num_threads=None, inter_op_num_threads=1):
         import onnxruntime
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
+        # on cpu use as many threads as eager torch by default, a single thread made onnx slower than eager
+        if intra_op_num_threads is None:
+            intra_op_num_threads = 1 if torch.cuda.is_available() else torch.get_num_threads()
+        option.intra_op_num_threads = intra_op_num_threads
+        option.inter_op_num_threads = inter_op_num_threads
         providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
         del self.flow.decoder.estimator
         self.flow.decoder.estimator = onnxruntime.InferenceSession(flow_decoder_estimator_model, sess_options=option, providers=providers)
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+    @contextmanager
+    def session(self, speech_tokens=None, llm_end=False):
+        """Register a session for one request, release it on completion, exception or generator close"""
+        session = TTSSession(speech_tokens, llm_end)
+        with self.lock:
+            self.sessions[session.uuid] = session
+        try:
+            yield session
+        finally:
+            with self.lock:
+                self.sessions.pop(session.uuid, None)
+            session.release()
+
+    def session_stats(self):
+        """Gauge of live sessions and the cache bytes they hold, a growing value means a leak"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {'live_sessions': len(sessions), 'bytes_held': sum(session.nbytes() for session in sessions)}
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
         if self.fp16 is True:
             llm_embedding = llm_embedding.half()
-        with self.llm_context:
-            for i in self.llm.inference(text=text.to(self.device),
-                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_text=prompt_text.to(self.device),
-                                        prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                        prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                        embedding=llm_embedding.to(self.device)):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        cond = session.cond
+        inputs = dict(text=text.to(self.device),
+                      text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                      prompt_text=prompt_text.to(self.device),
+                      prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                      embedding=llm_embedding.to(self.device))
+        request = None
+        try:
+            if self.llm_batch_decoder.supported():
+                request = self.llm_batch_decoder.submit(**inputs)
+                tokens, context = request, nullcontext()
+            else:
+                tokens, context = self.llm.inference(**inputs), self.llm_context
+            with context:
+                for i in tokens:
+                    with cond:
+                        # consumer is gone, stop decoding instead of filling a released session
+                        if session.released:
+                            break
+                        session.speech_tokens.append(i)
+                        cond.notify()
+        finally:
+            if request is not None:
+                request.cancel()
+            # always mark llm end, otherwise the consumer would wait forever when llm fails
+            with cond:
+                session.llm_end = True
+                cond.notify()
+
+    def wait_tokens(self, session, token_len):
+        """Block until token_len tokens are ready or llm ends, return whether a full chunk is ready"""
+        with session.cond:
+            session.cond.wait_for(lambda: len(session.speech_tokens) >= token_len or session.llm_end is True)
+            return len(session.speech_tokens) >= token_len
+
+    def flow_solve(self, z, mu, mask, n_timesteps, spks, cond, solver):
+        """ConditionalCFM.solve of one request, micro-batched with concurrent sessions of the same mel length"""
+        # the estimator normalizes over the whole time axis, padded rows would not match their batch-1 solve
+        return self.flow_batcher.submit((z.shape[2], n_timesteps, solver), (z, mu, mask, spks, cond))
+
+    def _flow_solve_batch(self, key, items):
+        _, n_timesteps, solver = key
+        z, mu, mask, spks, cond = [torch.concat(tensors, dim=0) for tensors in zip(*items)]
+        feat = self.flow.decoder.solve(z, mu, mask, n_timesteps, spks, cond, solver)
+        return list(feat.split(1, dim=0))
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def hift_inference(self, speech_feat):
+        """Single call vocoding of a whole mel, micro-batched with concurrent sessions of the same mel length"""
+        # hift has no mask, padding would change the receptive field of the tail
+        return self.hift_batcher.submit(speech_feat.shape[2], speech_feat)
+
+    def _hift_inference_batch(self, key, items):
+        # source phase and noise are drawn per row, so every row is an independent batch-1 draw
+        tts_speech, _ = self.hift.inference(speech_feat=torch.concat(items, dim=0))
+        return list(tts_speech.split(1, dim=0))
+
+    @torch.inference_mode()
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0,
+                  n_timesteps=10, solver='euler'):
+        # opt-in: streaming chunks encode the prompt once per session, a single non-stream call keeps the joint encoding
+        if self.stream_prompt_cache and finalize is False and session.flow_prompt_cache is None and \
+                self.flow.supports_prompt_cache():
+            session.flow_prompt_cache = self.flow.encode_prompt(prompt_token.to(self.device), embedding.to(self.device))
         tts_mel, flow_cache = self.flow.inference(token=token.to(self.device),
                                                   token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                   prompt_token=prompt_token.to(self.device),
@@ -108,149 +238,158 @@ class CosyVoiceModel:
                                                   prompt_feat=prompt_feat.to(self.device),
                                                   prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                   embedding=embedding.to(self.device),
-                                                  flow_cache=self.flow_cache_dict[uuid])
-        self.flow_cache_dict[uuid] = flow_cache
+                                                  flow_cache=session.flow_cache,
+                                                  n_timesteps=n_timesteps,
+                                                  solver=solver,
+                                                  prompt_cache=session.flow_prompt_cache,
+                                                  decoder_solve=self.flow_solve)
+        session.flow_cache = flow_cache
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
+        # streaming vocoder, every speech sample is computed once from its complete receptive field
+        if finalize is False and session.hift_stream is None and self.hift_streaming:
+            session.hift_stream = HiFTStream(self.hift)
+        if session.hift_stream is not None:
+            assert speed == 1.0, 'speed change only support non-stream inference mode'
+            if finalize is False:
+                session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
+                tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
+            return session.hift_stream(tts_mel, last=finalize)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source = torch.zeros(1, 1, 0, device=self.device)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            else:
+                tts_speech = self.hift_inference(tts_mel)
         return tts_speech
 
     def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, n_timesteps=10, solver='euler', **kwargs):
+        # session holds all variables related to this inference thread, released even if the caller stops iterating
+        with self.session() as session:
+            yield from self._tts(session, text, flow_embedding, llm_embedding, prompt_text, llm_prompt_speech_token,
+                                 flow_prompt_speech_token, prompt_speech_feat, stream, speed, n_timesteps, solver)
+
+    def _tts(self, session, text, flow_embedding, llm_embedding, prompt_text, llm_prompt_speech_token,
+             flow_prompt_speech_token, prompt_speech_feat, stream, speed, n_timesteps, solver):
+        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session))
         p.start()
         if stream is True:
             token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+            while self.wait_tokens(session, token_hop_len + self.token_overlap_len):
+                with session.cond:
+                    this_tts_speech_token = torch.tensor(session.speech_tokens[:token_hop_len + self.token_overlap_len]) \
                         .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=False,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver)
+                yield {'tts_speech': this_tts_speech.cpu()}
+                with session.cond:
+                    session.speech_tokens = session.speech_tokens[token_hop_len:]
+                # increase token_hop_len for better speech quality
+                token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
             p.join()
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
+                                             session=session,
+                                             finalize=True,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True,
-                                             speed=speed)
+                                             speed=speed,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
 
-    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = source_speech_token.flatten().tolist(), True
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0,
+           n_timesteps=10, solver='euler', **kwargs):
+        # session holds all variables related to this inference thread, released even if the caller stops iterating
+        with self.session(source_speech_token.flatten().tolist(), llm_end=True) as session:
+            yield from self._vc(session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream, speed, n_timesteps, solver)
+
+    def _vc(self, session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream, speed, n_timesteps, solver):
         if stream is True:
             token_hop_len = self.token_min_hop_len
-            while True:
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
+            while self.wait_tokens(session, token_hop_len + self.token_overlap_len):
+                this_tts_speech_token = torch.tensor(session.speech_tokens[:token_hop_len + self.token_overlap_len]) \
+                    .unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=False,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver)
+                yield {'tts_speech': this_tts_speech.cpu()}
+                session.speech_tokens = session.speech_tokens[token_hop_len:]
+                # increase token_hop_len for better speech quality
+                token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
+                                             session=session,
+                                             finalize=True,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True,
-                                             speed=speed)
+                                             speed=speed,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
@@ -56,6 +56,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
         self.decoder = decoder
         self.length_regulator = length_regulator
         self.only_mask_loss = only_mask_loss
+        # chunks can attend to cached prompt keys/values only if no layer has a (non causal) convolution module,
+        # decided on the eager encoder since a jit encoder loaded later hides its layers
+        self.encoder_chunkable = hasattr(self.encoder, 'encoders') and \
+            all(getattr(layer, 'conv_module', None) is None for layer in self.encoder.encoders)
 
     def forward(
             self,
@@ -101,6 +105,21 @@ class MaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    def supports_prompt_cache(self) -> bool:
+        return self.encoder_chunkable and hasattr(self.encoder, 'forward_chunk')
+
+    @torch.inference_mode()
+    def encode_prompt(self, prompt_token, embedding):
+        """Encode the prompt once for a streaming session, pass the result as prompt_cache to inference"""
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_token.shape[1] == 0:
+            h = torch.zeros([1, 0, self.output_size], device=embedding.device, dtype=embedding.dtype)
+            return {'embedding': embedding, 'h': h, 'att_cache': torch.zeros(0, 0, 0, 0, device=embedding.device)}
+        xs = self.input_embedding(torch.clamp(prompt_token, min=0))
+        h, att_cache, _ = self.encoder.forward_chunk(xs, 0, -1)
+        return {'embedding': embedding, 'h': self.encoder_proj(h), 'att_cache': att_cache}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -110,21 +129,32 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver='euler',
+                  prompt_cache=None,
+                  decoder_solve=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
-
-        # concat text and prompt_text
         token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+        if prompt_cache is None:
+            # xvec projection
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
 
-        # text encode
-        h, h_lengths = self.encoder(token, token_len)
-        h = self.encoder_proj(h)
+            # concat text and prompt_text
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+            mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+            token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+            # text encode
+            h, h_lengths = self.encoder(token, token_len)
+            h = self.encoder_proj(h)
+        else:
+            # prompt already encoded by encode_prompt, only the new tokens are encoded, attending to its cached keys/values
+            embedding = prompt_cache['embedding']
+            token = self.input_embedding(torch.clamp(token, min=0))
+            h, _, _ = self.encoder.forward_chunk(token, token_len1, 0, prompt_cache['att_cache'])
+            h = torch.concat([prompt_cache['h'], self.encoder_proj(h)], dim=1)
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
         h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
 
@@ -134,15 +164,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
         conds = conds.transpose(1, 2)
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
-        feat, flow_cache = self.decoder(
-            mu=h.transpose(1, 2).contiguous(),
-            mask=mask.unsqueeze(1),
-            spks=embedding,
-            cond=conds,
-            n_timesteps=10,
-            prompt_len=mel_len1,
-            flow_cache=flow_cache
-        )
+        # decoder_solve may run the ode of several requests as one batch, see CosyVoiceModel
+        z, mu, flow_cache = self.decoder.init_noise(h.transpose(1, 2).contiguous(), prompt_len=mel_len1, flow_cache=flow_cache)
+        decoder_solve = decoder_solve if decoder_solve is not None else self.decoder.solve
+        feat = decoder_solve(z, mu, mask.unsqueeze(1), n_timesteps, embedding, conds, solver)
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, flow_cache
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import numpy as np
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
@@ -33,8 +34,12 @@ class ConditionalCFM(BASECFM):
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
+    # ODE solvers selectable per request, and their estimator calls per step
+    SOLVERS = {'euler': 1, 'midpoint': 2, 'heun': 2, 'multistep': 1}
+
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2),
+                solver='euler'):
         """Forward diffusion
 
         Args:
@@ -47,12 +52,18 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, one of SOLVERS. Defaults to 'euler'.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
+        z, mu, flow_cache = self.init_noise(mu, temperature, prompt_len, flow_cache)
+        return self.solve(z, mu, mask, n_timesteps, spks, cond, solver), flow_cache
+
+    def init_noise(self, mu, temperature=1.0, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+        """Draw the initial noise of one request and apply/update its flow cache, returns z, mu, flow_cache"""
         z = torch.randn_like(mu) * temperature
         cache_size = flow_cache.shape[2]
         # fix prompt and overlap part mu and z
@@ -62,15 +73,57 @@ class ConditionalCFM(BASECFM):
         z_cache = torch.concat([z[:, :, :prompt_len], z[:, :, -34:]], dim=2)
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
+        return z, mu, flow_cache
 
+    @torch.inference_mode()
+    def solve(self, z, mu, mask, n_timesteps, spks=None, cond=None, solver='euler'):
+        """Integrate the ODE from noise z, z/mu/cond may be a zero padded batch of requests with mask marking valid frames"""
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        if solver not in self.SOLVERS:
+            raise ValueError('unknown flow solver {}, choose from {}'.format(solver, list(self.SOLVERS)))
+        solve = getattr(self, 'solve_{}'.format(solver))
+        return solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
+
+    def cfg_estimator(self, x, mu, mask, spks, cond):
+        """
+        Build the guided velocity field v(x, t) shared by all solvers.
+        Args:
+            x (torch.Tensor): random noise, only its shape is used
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker ids. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+            cond: Not used but kept for future purposes
+        """
+        if self.inference_cfg_rate <= 0:
+            return lambda x, t: self.forward_estimator(x, mask, mu, t, spks, cond)
+
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        # conditional and unconditional passes share one batch, the unconditional half keeps zero mu/spks/cond
+        batch_size = x.size(0)
+        x_in = torch.zeros([2 * batch_size, *x.shape[1:]], device=x.device, dtype=x.dtype)
+        mask_in = torch.concat([mask, mask], dim=0)
+        mu_in = torch.concat([mu, torch.zeros_like(mu)], dim=0)
+        t_in = torch.zeros([2 * batch_size], device=x.device, dtype=x.dtype)
+        spks_in = torch.concat([spks, torch.zeros_like(spks)], dim=0) if spks is not None else None
+        cond_in = torch.concat([cond, torch.zeros_like(cond)], dim=0) if cond is not None else None
+
+        def velocity(x, t):
+            x_in[:batch_size] = x
+            x_in[batch_size:] = x
+            t_in[:] = t
+            dphi_dt, cfg_dphi_dt = torch.split(self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in),
+                                               [batch_size, batch_size], dim=0)
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+        return velocity
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
-        Fixed euler solver for ODEs.
+        Fixed euler solver for ODEs, one estimator call per step.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -83,47 +136,75 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        velocity = self.cfg_estimator(x, mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            x = x + dt * velocity(x, t)
+        return x
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        """Explicit midpoint solver, two estimator calls per step, args see solve_euler"""
+        velocity = self.cfg_estimator(x, mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            x_mid = x + 0.5 * dt * velocity(x, t)
+            x = x + dt * velocity(x_mid, t + 0.5 * dt)
+        return x
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        """Heun (trapezoidal predictor-corrector) solver, two estimator calls per step, args see solve_euler"""
+        velocity = self.cfg_estimator(x, mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = velocity(x, t)
+            x_pred = x + dt * dphi_dt
+            x = x + 0.5 * dt * (dphi_dt + velocity(x_pred, t + dt))
+        return x
 
+    def solve_multistep(self, x, t_span, mu, mask, spks, cond):
+        """
+        Second order multistep solver in the spirit of DPM-Solver++(2M): reuses the previous
+        velocity (variable step Adams-Bashforth), one estimator call per step, args see solve_euler
+        """
+        velocity = self.cfg_estimator(x, mu, mask, spks, cond)
+        prev_dphi_dt, prev_dt = None, None
         for step in range(1, len(t_span)):
-            dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond)
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
-                cfg_dphi_dt = self.forward_estimator(
-                    x, mask,
-                    torch.zeros_like(mu), t,
-                    torch.zeros_like(spks) if spks is not None else None,
-                    torch.zeros_like(cond)
-                )
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
-                           self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1]
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = velocity(x, t)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                r = dt / (2 * prev_dt)
+                x = x + dt * ((1 + r) * dphi_dt - r * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x
 
     def forward_estimator(self, x, mask, mu, t, spks, cond):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
         else:
-            ort_inputs = {
-                'x': x.cpu().numpy(),
-                'mask': mask.cpu().numpy(),
-                'mu': mu.cpu().numpy(),
-                't': t.cpu().numpy(),
-                'spks': spks.cpu().numpy(),
-                'cond': cond.cpu().numpy()
-            }
-            output = self.estimator.run(None, ort_inputs)[0]
-            return torch.tensor(output, dtype=x.dtype, device=x.device)
+            return self.forward_estimator_onnx(x, mask, mu, t, spks, cond)
+
+    def forward_estimator_onnx(self, x, mask, mu, t, spks, cond):
+        """Run the onnxruntime estimator with io binding, torch buffers are bound in place, no numpy copies"""
+        use_cuda = 'CUDAExecutionProvider' in self.estimator.get_providers()
+        device = x.device if use_cuda and x.is_cuda else torch.device('cuda' if use_cuda else 'cpu')
+        device_type, device_id = device.type, device.index or 0
+        # exported estimator is fp32, keep references so the bound buffers stay alive during run
+        inputs = {name: tensor.to(device=device, dtype=torch.float32).contiguous()
+                  for name, tensor in (('x', x), ('mask', mask), ('mu', mu), ('t', t), ('spks', spks), ('cond', cond))}
+        output = torch.empty(inputs['x'].shape, dtype=torch.float32, device=device)
+        binding = self.estimator.io_binding()
+        for name, tensor in inputs.items():
+            binding.bind_input(name=name, device_type=device_type, device_id=device_id, element_type=np.float32,
+                               shape=tuple(tensor.shape), buffer_ptr=tensor.data_ptr())
+        binding.bind_output(name='estimator_out', device_type=device_type, device_id=device_id, element_type=np.float32,
+                            shape=tuple(output.shape), buffer_ptr=output.data_ptr())
+        if device_type == 'cuda':
+            # onnxruntime runs on its own stream, make sure torch finished writing the inputs
+            torch.cuda.current_stream(device).synchronize()
+        self.estimator.run_with_iobinding(binding)
+        return output.to(device=x.device, dtype=x.dtype)
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
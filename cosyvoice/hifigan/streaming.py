@@ -0,0 +1,335 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Chunked HiFTGenerator inference that carries convolution and overlap-add state between calls.
+
+Every operator of HiFTGenerator.decode is replayed on a stream: convolutions keep
+the input samples their next outputs still need, transposed convolutions and the
+istft keep their partial overlap-add tails, and the source module keeps its sine
+phase. An output sample is emitted once all of its receptive field has arrived,
+so each sample is computed exactly once and the concatenated chunks equal a
+single call on the whole mel (up to the random noise of the source module).
+"""
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.distributions.uniform import Uniform
+
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+from cosyvoice.hifigan.generator import HiFTGenerator, ResBlock
+
+
+def _weight(module: torch.nn.Module) -> torch.Tensor:
+    # weight_norm recomputes the weight in a forward pre-hook, which is bypassed here
+    if hasattr(module, 'weight_v'):
+        return torch._weight_norm(module.weight_v, module.weight_g, 0)
+    return module.weight
+
+
+class _Align:
+    """FIFOs lining up streams emitted with different delays, returns equally long heads"""
+
+    def __init__(self, num_streams: int):
+        self.buffers = [None] * num_streams
+
+    def __call__(self, *xs: torch.Tensor) -> List[torch.Tensor]:
+        xs = [x if b is None else torch.concat([b, x], dim=-1) for b, x in zip(self.buffers, xs)]
+        size = min(x.shape[-1] for x in xs)
+        self.buffers = [x[..., size:] for x in xs]
+        return [x[..., :size] for x in xs]
+
+
+class _StreamConv1d:
+    """Conv1d over a stream, zero padding is the initial state on the left and the flush on the right"""
+
+    def __init__(self, conv: torch.nn.Conv1d):
+        self.conv = conv
+        self.kernel = (conv.kernel_size[0] - 1) * conv.dilation[0] + 1
+        self.stride = conv.stride[0]
+        self.padding = conv.padding[0]
+        self.buffer = None
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.shape[0], x.shape[1], self.padding)
+        x = torch.concat([self.buffer, x], dim=2)
+        if last:
+            x = F.pad(x, (0, self.padding))
+        size = (x.shape[2] - self.kernel) // self.stride + 1 if x.shape[2] >= self.kernel else 0
+        self.buffer = x[:, :, size * self.stride:]
+        if size == 0:
+            return x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+        return F.conv1d(x[:, :, :(size - 1) * self.stride + self.kernel], _weight(self.conv), self.conv.bias,
+                        self.stride, 0, self.conv.dilation, self.conv.groups)
+
+
+class _OverlapAdd:
+    """Overlap-add of frames placed every hop samples, keeps the unfinished tail between calls"""
+
+    def __init__(self, frame_len: int, hop: int, trim_left: int, trim_right: int):
+        self.frame_len = frame_len
+        self.hop = hop
+        self.trim = trim_left
+        self.trim_right = trim_right
+        self.tail = None
+
+    def __call__(self, y: torch.Tensor, num_frames: int, last: bool = False) -> torch.Tensor:
+        # y (b, c, (num_frames - 1) * hop + frame_len) is the overlap-add of the new frames alone
+        if self.tail is not None:
+            y[:, :, :self.tail.shape[2]] += self.tail
+        ready, self.tail = y[:, :, :num_frames * self.hop], y[:, :, num_frames * self.hop:]
+        if last:
+            ready = torch.concat([ready, self.tail[:, :, :self.tail.shape[2] - self.trim_right]], dim=2)
+        if self.trim > 0:
+            trim = min(self.trim, ready.shape[2])
+            ready, self.trim = ready[:, :, trim:], self.trim - trim
+        return ready
+
+
+class _StreamConvTranspose1d:
+
+    def __init__(self, conv: torch.nn.ConvTranspose1d):
+        assert conv.dilation[0] == 1 and conv.output_padding[0] == 0 and conv.groups == 1
+        self.conv = conv
+        kernel, stride, padding = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+        assert kernel >= stride
+        self.ola = _OverlapAdd(kernel, stride, padding, padding)
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        if x.shape[2] == 0:
+            y = x.new_zeros(x.shape[0], self.conv.out_channels, self.ola.frame_len - self.ola.hop)
+        else:
+            y = F.conv_transpose1d(x, _weight(self.conv), None, self.conv.stride)
+        y = self.ola(y, x.shape[2], last)
+        if self.conv.bias is not None:
+            y = y + self.conv.bias.unsqueeze(-1)
+        return y
+
+
+class _StreamReflectionPadLeft:
+
+    def __init__(self, pad: torch.nn.ReflectionPad1d):
+        assert pad.padding[1] == 0
+        self.size = pad.padding[0]
+        self.pending = None
+        self.started = False
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        if self.started:
+            return x
+        x = x if self.pending is None else torch.concat([self.pending, x], dim=-1)
+        if x.shape[-1] <= self.size and not last:
+            self.pending = x
+            return x[..., :0]
+        self.pending, self.started = None, True
+        return torch.concat([x[..., 1:self.size + 1].flip(-1), x], dim=-1)
+
+
+class _StreamResBlock:
+
+    def __init__(self, block: ResBlock):
+        self.block = block
+        self.convs1 = [_StreamConv1d(conv) for conv in block.convs1]
+        self.convs2 = [_StreamConv1d(conv) for conv in block.convs2]
+        self.skips = [_Align(2) for _ in block.convs1]
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        for idx in range(len(self.convs1)):
+            xt = self.block.activations1[idx](x)
+            xt = self.convs1[idx](xt, last)
+            xt = self.block.activations2[idx](xt)
+            xt = self.convs2[idx](xt, last)
+            xt, x = self.skips[idx](xt, x)
+            x = xt + x
+        return x
+
+
+class _StreamF0Predictor:
+
+    def __init__(self, predictor: ConvRNNF0Predictor):
+        self.predictor = predictor
+        self.condnet = [_StreamConv1d(layer) if isinstance(layer, torch.nn.Conv1d) else layer for layer in predictor.condnet]
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        for layer in self.condnet:
+            x = layer(x, last) if isinstance(layer, _StreamConv1d) else layer(x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.predictor.classifier(x).squeeze(-1))
+
+
+class _StreamSource:
+    """f0 upsampling and SourceModuleHnNSF, the sine phase and its random offsets carry over"""
+
+    def __init__(self, hift: HiFTGenerator):
+        self.source = hift.m_source
+        self.upsample_scale = int(hift.f0_upsamp.scale_factor)
+        self.phase = None
+        self.phase_vec = None
+
+    def __call__(self, f0: torch.Tensor) -> torch.Tensor:
+        sine_gen = self.source.l_sin_gen
+        f0 = f0.repeat_interleave(self.upsample_scale, dim=-1).unsqueeze(1)
+        harmonics = torch.arange(1, sine_gen.harmonic_num + 2, device=f0.device, dtype=f0.dtype).view(1, -1, 1)
+        F_mat = f0 * harmonics / sine_gen.sampling_rate
+        if self.phase is None:
+            self.phase = F_mat.new_zeros(F_mat.shape[0], F_mat.shape[1], 1)
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            self.phase_vec = u_dist.sample(sample_shape=(F_mat.shape[0], F_mat.shape[1], 1)).to(F_mat.device)
+            self.phase_vec[:, 0, :] = 0
+        phase = (self.phase + torch.cumsum(F_mat, dim=-1)) % 1
+        if phase.shape[2] > 0:
+            self.phase = phase[:, :, -1:]
+        sine_waves = sine_gen.sine_amp * torch.sin(2 * np.pi * phase + self.phase_vec)
+        uv = sine_gen._f02uv(f0)
+        noise_amp = uv * sine_gen.noise_std + (1 - uv) * sine_gen.sine_amp / 3
+        sine_waves = sine_waves * uv + noise_amp * torch.randn_like(sine_waves)
+        return self.source.l_tanh(self.source.l_linear(sine_waves.transpose(1, 2))).squeeze(-1)
+
+
+class _StreamSTFT:
+    """torch.stft with center=True and reflect padding over a stream"""
+
+    def __init__(self, n_fft: int, hop: int, window: torch.Tensor):
+        self.n_fft = n_fft
+        self.hop = hop
+        self.window = window
+        self.pad = n_fft // 2
+        self.pending = None
+        self.buffer = None
+
+    def __call__(self, x: torch.Tensor, last: bool = False) -> torch.Tensor:
+        if self.buffer is None:
+            # the reflected left padding needs the first pad + 1 samples
+            x = x if self.pending is None else torch.concat([self.pending, x], dim=-1)
+            if x.shape[-1] <= self.pad and not last:
+                self.pending = x
+                return x.new_zeros(x.shape[0], self.n_fft + 2, 0)
+            self.pending = None
+            x = torch.concat([x[..., 1:self.pad + 1].flip(-1), x], dim=-1)
+        else:
+            x = torch.concat([self.buffer, x], dim=-1)
+        if last:
+            x = torch.concat([x, x[..., -self.pad - 1:-1].flip(-1)], dim=-1)
+        size = (x.shape[-1] - self.n_fft) // self.hop + 1 if x.shape[-1] >= self.n_fft else 0
+        self.buffer = x[..., size * self.hop:]
+        if size == 0:
+            return x.new_zeros(x.shape[0], self.n_fft + 2, 0)
+        spec = torch.stft(x[..., :(size - 1) * self.hop + self.n_fft], self.n_fft, self.hop, self.n_fft,
+                          window=self.window.to(x.device), center=False, return_complex=True)
+        spec = torch.view_as_real(spec)
+        return torch.cat([spec[..., 0], spec[..., 1]], dim=1)
+
+
+class _StreamISTFT:
+    """torch.istft with center=True over a stream"""
+
+    def __init__(self, n_fft: int, hop: int, window: torch.Tensor):
+        self.n_fft = n_fft
+        self.hop = hop
+        self.window = window
+        self.eye = None
+        # speech and window envelope share one overlap-add, as two channels
+        self.ola = _OverlapAdd(n_fft, hop, n_fft // 2, n_fft // 2)
+
+    def __call__(self, magnitude: torch.Tensor, phase: torch.Tensor, last: bool = False) -> torch.Tensor:
+        window = self.window.to(magnitude.device)
+        if self.eye is None:
+            self.eye = torch.eye(self.n_fft, device=magnitude.device, dtype=magnitude.dtype).unsqueeze(1)
+        batch_size, num_frames = magnitude.shape[0], magnitude.shape[2]
+        if num_frames == 0:
+            y = magnitude.new_zeros(batch_size, 2, self.n_fft - self.hop)
+        else:
+            magnitude = torch.clip(magnitude, max=1e2)
+            frames = torch.fft.irfft(torch.complex(magnitude * torch.cos(phase), magnitude * torch.sin(phase)), n=self.n_fft, dim=1)
+            frames = frames * window.view(1, -1, 1)
+            envelope = window.pow(2).view(1, -1, 1).expand(batch_size, -1, num_frames)
+            y = F.conv_transpose1d(torch.concat([frames, envelope], dim=0), self.eye, stride=self.hop)
+            y = y.view(2, batch_size, -1).transpose(0, 1)
+        y = self.ola(y, num_frames, last)
+        return y[:, 0] / y[:, 1]
+
+
+class HiFTStream:
+    """Vocode a mel stream chunk by chunk with a HiFTGenerator
+
+    Call it with consecutive mel chunks (b, 80, t) and last=True on the final one,
+    each call returns the speech samples whose receptive field is complete.
+    """
+
+    def __init__(self, hift: HiFTGenerator):
+        self.hift = hift
+        n_fft, hop = hift.istft_params['n_fft'], hift.istft_params['hop_len']
+        self.f0_predictor = _StreamF0Predictor(hift.f0_predictor)
+        self.source = _StreamSource(hift)
+        self.stft = _StreamSTFT(n_fft, hop, hift.stft_window)
+        self.conv_pre = _StreamConv1d(hift.conv_pre)
+        self.ups = [_StreamConvTranspose1d(up) for up in hift.ups]
+        self.reflection_pad = _StreamReflectionPadLeft(hift.reflection_pad)
+        self.source_downs = [_StreamConv1d(down) for down in hift.source_downs]
+        self.source_resblocks = [_StreamResBlock(block) for block in hift.source_resblocks]
+        self.fusions = [_Align(2) for _ in hift.ups]
+        self.resblocks = [_StreamResBlock(block) for block in hift.resblocks]
+        self.kernel_means = [_Align(hift.num_kernels) for _ in hift.ups]
+        self.conv_post = _StreamConv1d(hift.conv_post)
+        self.istft = _StreamISTFT(n_fft, hop, hift.stft_window)
+
+    @staticmethod
+    def supported(hift: torch.nn.Module) -> bool:
+        return type(hift) is HiFTGenerator and type(hift.f0_predictor) is ConvRNNF0Predictor
+
+    def nbytes(self) -> int:
+        tensors = []
+        for value in self.__dict__.values():
+            for stream in value if isinstance(value, list) else [value]:
+                for state in getattr(stream, '__dict__', {}).values():
+                    if isinstance(state, torch.Tensor):
+                        tensors.append(state)
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    @torch.inference_mode()
+    def __call__(self, speech_feat: torch.Tensor, last: bool = False) -> torch.Tensor:
+        hift = self.hift
+        n_fft = hift.istft_params['n_fft']
+        # mel->f0->source
+        f0 = self.f0_predictor(speech_feat, last)
+        s_stft = self.stft(self.source(f0), last)
+
+        # mel+source->speech, same operators as HiFTGenerator.decode
+        x = self.conv_pre(speech_feat, last)
+        for i in range(hift.num_upsamples):
+            x = F.leaky_relu(x, hift.lrelu_slope)
+            x = self.ups[i](x, last)
+
+            if i == hift.num_upsamples - 1:
+                x = self.reflection_pad(x, last)
+
+            # fusion
+            si = self.source_downs[i](s_stft, last)
+            si = self.source_resblocks[i](si, last)
+            x, si = self.fusions[i](x, si)
+            x = x + si
+
+            xs = self.kernel_means[i](*[self.resblocks[i * hift.num_kernels + j](x, last) for j in range(hift.num_kernels)])
+            x = xs[0]
+            for j in range(1, hift.num_kernels):
+                x = x + xs[j]
+            x = x / hift.num_kernels
+
+        x = F.leaky_relu(x)
+        x = self.conv_post(x, last)
+        magnitude = torch.exp(x[:, :n_fft // 2 + 1, :])
+        phase = torch.sin(x[:, n_fft // 2 + 1:, :])
+        x = self.istft(magnitude, phase, last)
+        return torch.clamp(x, -hift.audio_limit, hift.audio_limit)
@@ -0,0 +1,272 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batched speech token decoding for TransformerLM."""
+import logging
+import threading
+from contextlib import nullcontext
+from queue import Queue, Empty
+from typing import List
+
+import torch
+
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding, NoPositionalEncoding
+from cosyvoice.transformer.encoder_layer import TransformerEncoderLayer
+from cosyvoice.utils.common import push_token_window
+
+# end of token stream
+_DONE = object()
+
+
+class SpeechTokenRequest:
+    """One tts request in the batch, iterate it to get speech tokens as they are decoded"""
+
+    def __init__(self, inputs: dict):
+        self.inputs = inputs
+        self.min_len = 0
+        self.max_len = 0
+        self.out_tokens = []
+        self.cancelled = False
+        self.finished = False
+        self.error = None
+        self._tokens = Queue()
+
+    def cancel(self):
+        """Drop this request at the next token boundary"""
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            token = self._tokens.get()
+            if token is _DONE:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+    def _emit(self, token: int):
+        self.out_tokens.append(token)
+        self._tokens.put(token)
+
+    def _finish(self, error: Exception = None):
+        self.error = error
+        self.finished = True
+        self._tokens.put(_DONE)
+
+
+class BatchSpeechTokenDecoder:
+    """Decode speech tokens of concurrent requests in one batch
+
+    New requests are prefilled alone and merged into the running batch at a
+    token boundary, right aligned and left padded in a shared preallocated
+    attention cache, finished requests leave the batch at any step. Each row
+    is sampled with its own recent token window and min/max length, exactly
+    like TransformerLM.inference, in one vectorized sampling call per step.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 8, context=None, sampling: int = 25):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.sampling = sampling
+        self.context = context if context is not None else nullcontext()
+        self._pending = Queue()
+        self._active: List[SpeechTokenRequest] = []
+        # batch state, att_cache (elayers, b, head, capacity, d_k * 2) with rows right aligned at offset
+        self._att_cache = None
+        self._key_mask = None
+        self._offset = 0
+        self._next_input = None
+        self._token_window = None
+        self._num_tokens = None
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def supported(self) -> bool:
+        """Left padding keeps outputs unchanged only if positions are purely relative,
+        jit exported llm has no forward_chunk_static"""
+        if isinstance(self.llm.llm, torch.jit.ScriptModule):
+            return False
+        if not all(isinstance(layer, TransformerEncoderLayer) for layer in self.llm.llm.encoders):
+            return False
+        pos_enc = getattr(self.llm.llm.embed, 'pos_enc', None)
+        return isinstance(pos_enc, (EspnetRelPositionalEncoding, NoPositionalEncoding))
+
+    def submit(self, **inputs) -> SpeechTokenRequest:
+        """Queue a request, inputs are the keyword arguments of TransformerLM.prepare_lm_input"""
+        request = SpeechTokenRequest(inputs)
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._pending.put(request)
+        return request
+
+    @property
+    def num_active(self) -> int:
+        return len(self._active)
+
+    def _run(self):
+        with self.context, torch.inference_mode():
+            while True:
+                # requests admitted in this iteration, a failed merge may leave them out of _active
+                admitted = []
+                try:
+                    if not self._active:
+                        request = self._pending.get()
+                        admitted.append(request)
+                        self._admit(request)
+                    while len(self._active) < self.max_batch_size:
+                        try:
+                            request = self._pending.get_nowait()
+                        except Empty:
+                            break
+                        admitted.append(request)
+                        self._admit(request)
+                    if self._active:
+                        self._decode_step()
+                except Exception as e:
+                    # fail only the affected requests and start from an empty batch, the shared thread must survive
+                    logging.exception('batch speech token decoding failed')
+                    for request in self._active + admitted:
+                        if not request.finished:
+                            request._finish(e)
+                    self._reset_batch()
+
+    def _admit(self, request: SpeechTokenRequest):
+        """Prefill a new request alone, then merge it into the batch"""
+        if request.cancelled:
+            request._finish()
+            return
+        try:
+            lm_input, request.min_len, request.max_len = self.llm.prepare_lm_input(**request.inputs)
+            request.inputs = None
+            if request.max_len <= 0:
+                request._finish()
+                return
+            length = lm_input.size(1)
+            row_cache = self.llm.init_att_cache(length, lm_input.dtype, lm_input.device)
+            y_pred, _ = self.llm.llm.forward_chunk_static(lm_input, offset=0, att_cache=row_cache,
+                                                          att_mask=self.llm.causal_mask(length, lm_input.device))
+            logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+            token_window = self.llm.init_token_window(lm_input.device)
+            num_tokens = torch.zeros(1, dtype=torch.long, device=lm_input.device)
+            token = self._sample(logp, [request], token_window, num_tokens)[0]
+        except Exception as e:
+            request._finish(e)
+            return
+        if self._accept(request, token):
+            self._merge_row(request, row_cache, token, token_window, num_tokens)
+
+    def _accept(self, request: SpeechTokenRequest, token: int) -> bool:
+        """Route a sampled token to its request, return whether the request stays in the batch"""
+        if request.cancelled or token == self.llm.speech_token_size:
+            request._finish()
+            return False
+        request._emit(token)
+        if len(request.out_tokens) >= request.max_len:
+            request._finish()
+            return False
+        return True
+
+    def _merge_row(self, request: SpeechTokenRequest, row_cache: torch.Tensor, token: int,
+                   token_window: torch.Tensor, num_tokens: torch.Tensor):
+        length = row_cache.size(3)
+        row_input = self.llm.speech_embedding.weight[token].reshape(1, 1, -1)
+        if not self._active:
+            self._att_cache = self.llm.init_att_cache(length + request.max_len, row_cache.dtype, row_cache.device)
+            self._att_cache[:, :, :, :length] = row_cache
+            self._key_mask = torch.zeros((1, self._att_cache.size(3)), dtype=torch.bool, device=row_cache.device)
+            self._key_mask[:, :length] = True
+            self._offset = length
+            self._next_input = row_input
+            self._token_window, self._num_tokens = token_window, num_tokens
+            self._active = [request]
+            return
+
+        # a longer prompt shifts the running rows right, so every row still ends at offset
+        batch_size = len(self._active)
+        offset = max(self._offset, length)
+        shift = offset - self._offset
+        capacity = max(self._att_cache.size(3) + shift, offset + request.max_len)
+        att_cache = self.llm.init_att_cache(capacity, row_cache.dtype, row_cache.device, batch_size + 1)
+        att_cache[:, :batch_size, :, shift:offset] = self._att_cache[:, :, :, :self._offset]
+        att_cache[:, batch_size:, :, offset - length:offset] = row_cache
+        key_mask = torch.zeros((batch_size + 1, capacity), dtype=torch.bool, device=row_cache.device)
+        key_mask[:batch_size, shift:offset] = self._key_mask[:, :self._offset]
+        key_mask[batch_size, offset - length:offset] = True
+        self._att_cache, self._key_mask, self._offset = att_cache, key_mask, offset
+        self._next_input = torch.concat([self._next_input, row_input], dim=0)
+        self._token_window = torch.concat([self._token_window, token_window], dim=0)
+        self._num_tokens = torch.concat([self._num_tokens, num_tokens], dim=0)
+        self._active.append(request)
+
+    def _ensure_capacity(self, size: int):
+        capacity = self._att_cache.size(3)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        att_cache = self.llm.init_att_cache(capacity, self._att_cache.dtype, self._att_cache.device, self._att_cache.size(1))
+        att_cache[:, :, :, :self._offset] = self._att_cache[:, :, :, :self._offset]
+        key_mask = self._key_mask.new_zeros((self._key_mask.size(0), capacity))
+        key_mask[:, :self._offset] = self._key_mask[:, :self._offset]
+        self._att_cache, self._key_mask = att_cache, key_mask
+
+    def _decode_step(self):
+        """Forward one token for the whole batch, drop finished rows"""
+        self._ensure_capacity(self._offset + 1)
+        self._key_mask[:, self._offset] = True
+        att_mask = self._key_mask[:, :self._offset + 1].unsqueeze(1)
+        y_pred, _ = self.llm.llm.forward_chunk_static(self._next_input, offset=self._offset,
+                                                      att_cache=self._att_cache, att_mask=att_mask)
+        self._offset += 1
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        tokens = self._sample(logp, self._active, self._token_window, self._num_tokens)
+        keep_rows = [row for row, (request, token) in enumerate(zip(self._active, tokens)) if self._accept(request, token)]
+        if len(keep_rows) != len(self._active):
+            self._keep_rows(keep_rows)
+        if self._active:
+            next_tokens = torch.tensor([tokens[row] for row in keep_rows], device=logp.device)
+            self._next_input = self.llm.speech_embedding.weight[next_tokens].unsqueeze(dim=1)
+
+    def _sample(self, logp: torch.Tensor, requests: List[SpeechTokenRequest],
+                token_window: torch.Tensor, num_tokens: torch.Tensor) -> List[int]:
+        """Sample all rows at once and push the ids into their token windows"""
+        ignore_eos = torch.tensor([len(request.out_tokens) < request.min_len for request in requests], device=logp.device)
+        top_ids = self.llm.sampling_ids(logp, token_window, self.sampling, ignore_eos=ignore_eos).squeeze(dim=1)
+        push_token_window(token_window, num_tokens, top_ids)
+        num_tokens += 1
+        return top_ids.tolist()
+
+    def _keep_rows(self, rows: List[int]):
+        """Keep the given rows and trim the left padding no remaining row needs"""
+        if not rows:
+            self._reset_batch()
+            return
+        index = torch.tensor(rows, dtype=torch.long, device=self._key_mask.device)
+        self._active = [self._active[row] for row in rows]
+        key_mask = self._key_mask.index_select(0, index)
+        trim = int(key_mask[:, :self._offset].any(dim=0).int().argmax())
+        self._key_mask = key_mask[:, trim:]
+        self._att_cache = self._att_cache.index_select(1, index)[:, :, :, trim:]
+        self._token_window = self._token_window.index_select(0, index)
+        self._num_tokens = self._num_tokens.index_select(0, index)
+        self._offset -= trim
+
+    def _reset_batch(self):
+        self._active = []
+        self._att_cache = None
+        self._key_mask = None
+        self._offset = 0
+        self._next_input = None
+        self._token_window = None
+        self._num_tokens = None
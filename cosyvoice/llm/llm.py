@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Tuple, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -19,6 +19,7 @@ from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import push_token_window
 
 
 class TransformerLM(torch.nn.Module):
@@ -64,8 +65,12 @@ class TransformerLM(torch.nn.Module):
         self.speech_embedding = torch.nn.Embedding(speech_token_size, llm_input_size)
         self.spk_embed_affine_layer = torch.nn.Linear(spk_embed_dim, llm_input_size)
 
-        # 4. sampling method
+        # 4. sampling method, decoded tokens are kept in an on device window as wide as the ras window
         self.sampling = sampling
+        self.sampling_win_size = getattr(sampling, 'keywords', {}).get('win_size', 10)
+
+        # 5. causal mask cache for decoding, grown on demand
+        self.causal_mask_cache = torch.ones((0, 0), dtype=torch.bool)
 
     def encode(
             self,
@@ -136,21 +141,44 @@ class TransformerLM(torch.nn.Module):
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 1), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
+    def causal_mask(self, size: int, device: torch.device) -> torch.Tensor:
+        """Return a (1, size, size) causal mask sliced from the cached one"""
+        if self.causal_mask_cache.size(0) < size or self.causal_mask_cache.device != device:
+            size_to_cache = max(size, self.causal_mask_cache.size(0))
+            self.causal_mask_cache = torch.tril(torch.ones((size_to_cache, size_to_cache), dtype=torch.bool, device=device))
+        return self.causal_mask_cache[:size, :size].unsqueeze(0)
+
+    def init_att_cache(self, max_len: int, dtype: torch.dtype, device: torch.device, batch_size: int = 1) -> torch.Tensor:
+        """Preallocate the attention cache buffer (elayers, batch_size, head, max_len, d_k * 2) of self.llm"""
+        self_attn = self.llm.encoders[0].self_attn
+        return torch.zeros((len(self.llm.encoders), batch_size, self_attn.h, max_len, self_attn.d_k * 2), dtype=dtype, device=device)
+
+    def init_token_window(self, device: torch.device, batch_size: int = 1) -> torch.Tensor:
+        """Empty (batch_size, sampling_win_size) window of recent decoded tokens"""
+        return torch.full((batch_size, self.sampling_win_size), -1, dtype=torch.long, device=device)
+
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
     ):
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-        return top_ids
+        """Sample (batch, 1) ids from (batch, vocab) scores, ignore_eos is a bool or a (batch,) bool tensor
+
+        EOS is masked out of the distribution instead of resampling until it is not drawn.
+        """
+        eos = self.speech_token_size
+        if isinstance(ignore_eos, torch.Tensor):
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., eos] = weighted_scores[..., eos].masked_fill(ignore_eos, -float('inf'))
+        elif ignore_eos:
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., eos] = -float('inf')
+        return self.sampling(weighted_scores, decoded_tokens, sampling)
 
     @torch.inference_mode()
-    def inference(
+    def prepare_lm_input(
             self,
             text: torch.Tensor,
             text_len: torch.Tensor,
@@ -159,10 +187,10 @@ class TransformerLM(torch.nn.Module):
             prompt_speech_token: torch.Tensor,
             prompt_speech_token_len: torch.Tensor,
             embedding: torch.Tensor,
-            sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
-    ) -> Generator[torch.Tensor, None, None]:
+    ) -> Tuple[torch.Tensor, int, int]:
+        """Build the (1, T, llm_input_size) decoder prompt and the min/max speech token length"""
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
@@ -191,22 +219,55 @@ class TransformerLM(torch.nn.Module):
         # 4. cal min/max_length
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        return lm_input, min_len, max_len
+
+    @torch.inference_mode()
+    def inference(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                                           prompt_speech_token, prompt_speech_token_len, embedding,
+                                                           max_token_text_ratio, min_token_text_ratio)
 
         # 5. step by step decode
-        out_tokens = []
+        token_window = self.init_token_window(lm_input.device)
+        num_tokens = torch.zeros(1, dtype=torch.long, device=lm_input.device)
         offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # jit exported llm only has forward_chunk, which concatenates the cache every step
+        static_cache = not isinstance(self.llm, torch.jit.ScriptModule)
+        if static_cache is True:
+            att_cache = self.init_att_cache(lm_input.shape[1] + max_len, lm_input.dtype, lm_input.device)
+        else:
+            att_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            # prefill is causal over the prompt, every later step is a single token which sees all frames
+            att_mask = self.causal_mask(lm_input.shape[1], lm_input.device)
+            if static_cache is True:
+                y_pred, cnn_cache = self.llm.forward_chunk_static(lm_input, offset=offset, att_cache=att_cache,
+                                                                  cnn_cache=cnn_cache, att_mask=att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=att_mask)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
-            if top_ids == self.speech_token_size:
+            top_ids = self.sampling_ids(logp, token_window, sampling, ignore_eos=True if i < min_len else False).squeeze(dim=1)
+            top_id = top_ids.item()
+            if top_id == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
-            yield top_ids
-            out_tokens.append(top_ids)
+            yield top_id
+            push_token_window(token_window, num_tokens, top_ids)
+            num_tokens += 1
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
@@ -79,6 +79,36 @@ class MultiHeadedAttention(nn.Module):
 
         return q, k, v
 
+    def write_static_cache(
+        self,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        cache: torch.Tensor,
+        cache_offset: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write k/v into a preallocated cache buffer in place.
+
+        Args:
+            k (torch.Tensor): Transformed key (#batch, head, time1, d_k).
+            v (torch.Tensor): Transformed value (#batch, head, time1, d_k).
+            cache (torch.Tensor): Preallocated buffer
+                (#batch, head, max_t, d_k * 2).
+            cache_offset (int): Number of valid frames already in `cache`.
+
+        Returns:
+            torch.Tensor: Key view of all valid frames
+                (#batch, head, cache_offset + time1, d_k).
+            torch.Tensor: Value view of all valid frames
+                (#batch, head, cache_offset + time1, d_k).
+
+        """
+        end = cache_offset + k.size(2)
+        cache[:, :, cache_offset:end, :self.d_k] = k
+        cache[:, :, cache_offset:end, self.d_k:] = v
+        # NOTE: only views of the valid prefix are attended, no copy of the
+        #   history is made, so the per-step cost stays flat
+        return cache[:, :, :end, :self.d_k], cache[:, :, :end, self.d_k:]
+
     def forward_attention(
         self,
         value: torch.Tensor,
@@ -133,7 +163,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +187,9 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): >=0 means `cache` is a preallocated buffer
+                (#batch, head, max_t, d_k * 2), k/v are written in place at
+                `cache_offset` and the buffer itself is returned as cache
 
 
         Returns:
@@ -183,15 +217,19 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_offset >= 0:
+            k, v = self.write_static_cache(k, v, cache, cache_offset)
+            new_cache = cache
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
@@ -253,7 +291,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +306,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): >=0 means `cache` is a preallocated buffer
+                (#batch, head, max_t, d_k * 2), see MultiHeadedAttention.forward
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,15 +333,19 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_offset >= 0:
+            k, v = self.write_static_cache(k, v, cache, cache_offset)
+            new_cache = cache
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
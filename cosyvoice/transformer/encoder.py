@@ -271,6 +271,64 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    def forward_chunk_static(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Forward just one chunk against a preallocated attention cache
+
+        Same as forward_chunk with required_cache_size < 0, but the KEY &
+        VALUE of every layer are written in place into `att_cache` instead
+        of being concatenated to the history, so decoding a long sequence
+        token by token costs no cache copies. Several sequences can be
+        decoded together, shorter ones left padded and masked by att_mask.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim)
+            offset (int): number of frames already written in att_cache
+            att_cache (torch.Tensor): preallocated cache buffer,
+                (elayers, b, head, max_t, d_k * 2), `max_t >= offset + time`
+            cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
+                (elayers, b, hidden-dim, cache_t2)
+            att_mask (torch.Tensor): mask of this chunk against all valid
+                frames, (b, time, offset + time) or (0, 0, 0)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, chunk_size, hidden-dim).
+            torch.Tensor: new conformer cnn cache required for next chunk, with
+                same shape as the original cnn_cache.
+
+        """
+        tmp_masks = torch.ones(xs.size(0),
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        tmp_masks = tmp_masks.unsqueeze(1)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=offset + xs.size(1))
+        r_cnn_cache = []
+        for i, layer in enumerate(self.encoders):
+            # att_cache[i] is a view, the layer writes into att_cache
+            xs, _, _, new_cnn_cache = layer(
+                xs,
+                att_mask,
+                pos_emb,
+                att_cache=att_cache[i],
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache,
+                att_cache_offset=offset)
+            r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, torch.cat(r_cnn_cache, dim=0)
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
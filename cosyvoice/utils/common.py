@@ -106,44 +106,54 @@ def init_weights(m, mean=0.0, std=0.01):
 
 
 # Repetition Aware Sampling in VALL-E 2
+# weighted_scores is (vocab,) or (batch, vocab), decoded_tokens is a list of decoded tokens
+# or a (batch, win_size) window of the most recent ones, see push_token_window
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
-    return top_ids
+    if isinstance(decoded_tokens, torch.Tensor):
+        window = decoded_tokens
+    else:
+        window = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=weighted_scores.device)
+    rep_num = (window == top_ids).sum(dim=-1, keepdim=True)
+    # sample both and select on device, no host sync per token
+    return torch.where(rep_num >= win_size * tau_r, random_sampling(weighted_scores, decoded_tokens, sampling), top_ids)
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
-    return top_ids
+    prob = weighted_scores.softmax(dim=-1)
+    top_k = min(top_k, prob.size(-1))
+    sorted_value, sorted_idx = prob.topk(top_k, dim=-1)
+    # sampling both top-p and numbers, keep a token while the mass before it is below top_p
+    cum_prob = sorted_value.cumsum(dim=-1) - sorted_value
+    sorted_value = sorted_value.masked_fill(cum_prob >= top_p, 0)
+    return sorted_idx.gather(-1, sorted_value.multinomial(1, replacement=True))
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
+def push_token_window(window, num_tokens, top_ids):
+    """Write top_ids (batch,) into the ring buffer window (batch, win_size) in place.
+
+    The order inside the window does not matter for counting repetitions, so
+    each row just overwrites its oldest slot at num_tokens % win_size. Empty
+    slots hold -1.
+    """
+    window.scatter_(1, (num_tokens % window.size(1)).unsqueeze(1), top_ids.unsqueeze(1))
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    """Crossfade the head of fade_in_mel with the tail of fade_out_mel in place on their device,
+    pass window as a tensor already on that device and dtype to avoid any copy"""
+    if not isinstance(window, torch.Tensor):
+        window = torch.from_numpy(window)
+    window = window.to(device=fade_in_mel.device, dtype=fade_in_mel.dtype)
     mel_overlap_len = int(window.shape[0] / 2)
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    fade_in_mel[..., :mel_overlap_len].mul_(window[:mel_overlap_len]) \
+        .addcmul_(fade_out_mel[..., -mel_overlap_len:], window[mel_overlap_len:])
+    return fade_in_mel
 
 
 def set_all_random_seed(seed):
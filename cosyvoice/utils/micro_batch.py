@@ -0,0 +1,94 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-batching of model calls issued by concurrent sessions."""
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Any, Callable, Hashable, List
+
+import torch
+
+
+class MicroBatcher:
+    """Group calls submitted within max_wait seconds into one batched call
+
+    run_batch(key, items) gets the items of one batch that share the same key
+    (e.g. length, step count and solver) and returns one result per item. Items
+    are never padded, so the key must pin every shape that differs between rows.
+    Callers block in submit until their result is scattered back. Until two
+    calls first overlap every call runs inline, as a single session has no peer
+    to wait for. From then on all calls go through the collector, so a call
+    never starts alone while a peer that could share its batch is queued.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.005):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # calls submitted and not returned yet, inline ones included
+        self._in_flight = 0
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, key: Hashable, item: Any) -> Any:
+        with self._lock:
+            alone = self.max_batch_size <= 1 or (self._worker is None and self._in_flight == 0)
+            self._in_flight += 1
+            if not alone and self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        try:
+            if alone:
+                return self.run_batch(key, [item])[0]
+            future = Future()
+            self._pending.put((key, item, future))
+            return future.result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _collect(self):
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                groups = {}
+                for key, item, future in self._collect():
+                    groups.setdefault(key, []).append((item, future))
+                for key, group in groups.items():
+                    try:
+                        results = self.run_batch(key, [item for item, _ in group])
+                    except Exception as e:
+                        for _, future in group:
+                            future.set_exception(e)
+                        continue
+                    for (_, future), result in zip(group, results):
+                        future.set_result(result)
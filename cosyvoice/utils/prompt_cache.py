@@ -0,0 +1,101 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Content hashed LRU cache of prompt derived frontend features."""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+
+
+def hash_prompt(value) -> str:
+    """Content hash of a prompt waveform tensor or a prompt text"""
+    sha1 = hashlib.sha1()
+    if isinstance(value, torch.Tensor):
+        value = value.detach().to('cpu', torch.float32).contiguous()
+        sha1.update(str(tuple(value.shape)).encode('utf-8'))
+        sha1.update(value.numpy().tobytes())
+    else:
+        sha1.update(str(value).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class PromptFeatureCache:
+    """LRU cache of frontend outputs keyed by prompt content, bounded by a byte budget
+
+    Entries are dicts of tensors. With cache_dir set every entry is also saved
+    as <key>.pt, so cloned voices survive restarts and entries evicted from
+    memory are reloaded from disk instead of recomputed.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, cache_dir: Optional[str] = None, device: torch.device = torch.device('cpu')):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.device = device
+        self.entries = OrderedDict()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def nbytes(entry: Dict[str, torch.Tensor]) -> int:
+        return sum(v.numel() * v.element_size() for v in entry.values() if isinstance(v, torch.Tensor))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, '{}.pt'.format(key))
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            entry = torch.load(self._path(key), map_location=self.device)
+            self._insert(key, entry)
+            with self.lock:
+                self.hits += 1
+            return entry
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, entry: Dict[str, torch.Tensor]):
+        self._insert(key, entry)
+        if self.cache_dir is not None:
+            torch.save({k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in entry.items()}, self._path(key))
+
+    def _insert(self, key: str, entry: Dict[str, torch.Tensor]):
+        size = self.nbytes(entry)
+        with self.lock:
+            if key in self.entries:
+                self.bytes_held -= self.nbytes(self.entries.pop(key))
+            # an entry larger than the whole budget is only kept on disk
+            if size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.bytes_held += size
+            while self.bytes_held > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes_held -= self.nbytes(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes_held': self.bytes_held, 'hits': self.hits, 'misses': self.misses}
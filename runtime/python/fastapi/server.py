@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import io
 import sys
 import argparse
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -36,37 +40,127 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"])
 
+# end of an audio stream
+_DONE = object()
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+
+class Admission:
+    """Bounded number of requests doing model work, the rest is rejected with 429 instead of queueing
+
+    Only touched from the event loop thread, so a plain counter is a non blocking semaphore.
+    """
+
+    def __init__(self, max_conc):
+        self.max_conc = max_conc
+        self.active = 0
+
+    def acquire(self):
+        if self.active >= self.max_conc:
+            raise HTTPException(status_code=429, detail='server is busy, retry later')
+        self.active += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
+        return release
+
+
+def produce_audio(model_output_fn, loop, queue, cancelled, release):
+    """Run on the executor, push int16 pcm chunks to the event loop until done or cancelled
+
+    The admission slot is held until the model work here has stopped, not until the client goes away.
+    """
+    model_output = None
+    try:
+        model_output = model_output_fn()
+        for i in model_output:
+            if cancelled.is_set():
+                break
+            tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+            loop.call_soon_threadsafe(queue.put_nowait, tts_audio)
+    except Exception as e:
+        logging.exception('inference failed')
+        loop.call_soon_threadsafe(queue.put_nowait, e)
+    finally:
+        # closing the generator releases the model session and stops its llm job
+        try:
+            if model_output is not None:
+                model_output.close()
+        finally:
+            loop.call_soon_threadsafe(release)
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+
+async def stream_audio(queue, cancelled):
+    try:
+        while True:
+            tts_audio = await queue.get()
+            if tts_audio is _DONE:
+                break
+            if isinstance(tts_audio, Exception):
+                raise tts_audio
+            yield tts_audio
+    finally:
+        # client disconnect cancels this generator, the producer stops at the next chunk and releases its slot
+        cancelled.set()
+
+
+def streaming_response(model_output_fn):
+    release = admission.acquire()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    try:
+        loop.run_in_executor(executor, produce_audio, model_output_fn, loop, queue, cancelled, release)
+    except Exception:
+        release()
+        raise
+    return StreamingResponse(stream_audio(queue, cancelled))
+
+
+@app.post("/add_zero_shot_spk")
+async def add_zero_shot_spk(spk_id: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File(),
+                            overwrite: bool = Form(False)):
+    prompt_wav = io.BytesIO(await prompt_wav.read())
+    release = admission.acquire()
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            executor, lambda: cosyvoice.add_zero_shot_spk(prompt_text, load_wav(prompt_wav, 16000), spk_id, overwrite=overwrite))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        release()
+    return {'spk_id': spk_id}
+
+
+@app.get("/list_spks")
+async def list_spks():
+    return {'spks': cosyvoice.list_avaliable_spks()}
 
 
 @app.get("/inference_sft")
 async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+    return streaming_response(lambda: cosyvoice.inference_sft(tts_text, spk_id))
 
 
 @app.get("/inference_zero_shot")
 async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    prompt_wav = io.BytesIO(await prompt_wav.read())
+    return streaming_response(lambda: cosyvoice.inference_zero_shot(tts_text, prompt_text, load_wav(prompt_wav, 16000)))
 
 
 @app.get("/inference_cross_lingual")
 async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    prompt_wav = io.BytesIO(await prompt_wav.read())
+    return streaming_response(lambda: cosyvoice.inference_cross_lingual(tts_text, load_wav(prompt_wav, 16000)))
 
 
 @app.get("/inference_instruct")
 async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+    return streaming_response(lambda: cosyvoice.inference_instruct(tts_text, spk_id, instruct_text))
 
 
 if __name__ == '__main__':
@@ -74,10 +168,18 @@ if __name__ == '__main__':
     parser.add_argument('--port',
                         type=int,
                         default=50000)
+    parser.add_argument('--max_conc',
+                        type=int,
+                        default=4)
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
     args = parser.parse_args()
-    cosyvoice = CosyVoice(args.model_dir)
+    # at most max_conc requests run at once, batch them all together
+    cosyvoice = CosyVoice(args.model_dir, llm_max_batch_size=args.max_conc,
+                          token2wav_max_batch_size=args.max_conc)
+    # model work runs here, never on the event loop
+    executor = ThreadPoolExecutor(max_workers=args.max_conc)
+    admission = Admission(args.max_conc)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
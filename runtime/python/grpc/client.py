@@ -30,6 +30,17 @@ from cosyvoice.utils.file_utils import load_wav
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+        if args.mode == 'add_speaker':
+            logging.info('send add_speaker request')
+            add_speaker_request = cosyvoice_pb2.addSpeakerRequest()
+            add_speaker_request.spk_id = args.spk_id
+            add_speaker_request.prompt_text = args.prompt_text
+            prompt_speech = load_wav(args.prompt_wav, 16000)
+            add_speaker_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            add_speaker_request.overwrite = args.overwrite
+            response = stub.AddSpeaker(add_speaker_request)
+            logging.info('speaker {} added'.format(response.spk_id))
+            return
         request = cosyvoice_pb2.Request()
         if args.mode == 'sft':
             logging.info('send sft request')
@@ -80,7 +91,7 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'add_speaker'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
@@ -98,6 +109,9 @@ if __name__ == "__main__":
                         type=str,
                         default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
                                  Fights with fervor for justice, but struggles with impulsiveness.')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='replace an existing speaker in add_speaker mode')
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
@@ -33,7 +33,9 @@ logging.basicConfig(level=logging.DEBUG,
 
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        self.cosyvoice = CosyVoice(args.model_dir)
+        # at most max_conc rpcs run at once, batch them all together
+        self.cosyvoice = CosyVoice(args.model_dir, llm_max_batch_size=args.max_conc,
+                                   token2wav_max_batch_size=args.max_conc)
         logging.info('grpc service initialized')
 
     def Inference(self, request, context):
@@ -64,6 +66,18 @@ class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
             response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
             yield response
 
+    def AddSpeaker(self, request, context):
+        logging.info('get add speaker request {}'.format(request.spk_id))
+        prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+        prompt_speech_16k = prompt_speech_16k.float() / (2**15)
+        try:
+            self.cosyvoice.add_zero_shot_spk(request.prompt_text, prompt_speech_16k, request.spk_id, overwrite=request.overwrite)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.ALREADY_EXISTS, str(e))
+        response = cosyvoice_pb2.addSpeakerResponse()
+        response.spk_id = request.spk_id
+        return response
+
 
 def main():
     grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)
@@ -9,8 +9,13 @@ import wave
 import os
 import tempfile
 import asyncio
+import threading
 import edge_tts
 import re
+from math import gcd
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
 from pypinyin import pinyin, Style
 import langid
 
@@ -93,6 +98,24 @@ def get_audio_duration(audio_file):
         print(f"获取音频时长失败: {e}")
         return 0.0
 
+def load_audio(audio_file, target_rate=AUDIO_RATE):
+    """
+    读取音频并转换为单声道 float32 PCM（供 ASR 与声纹验证共享）
+    
+    Args:
+        audio_file: 音频文件路径
+        target_rate: 目标采样率
+        
+    Returns:
+        np.ndarray: 单声道 PCM 数组，取值范围 [-1, 1]
+    """
+    audio, rate = sf.read(audio_file, dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if rate != target_rate:
+        divisor = gcd(rate, target_rate)
+        audio = resample_poly(audio, target_rate // divisor, rate // divisor).astype(np.float32)
+    return audio
+
 def is_folder_empty(folder_path):
     """
     检测文件夹是否为空
@@ -124,21 +147,64 @@ async def text_to_speech(text, voice=None):
     Returns:
         str: 音频文件路径
     """
+    audio_bytes = await text_to_speech_bytes(text, voice)
+    if not audio_bytes:
+        return None
+    
+    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as f:
+        f.write(audio_bytes)
+        return f.name
+
+async def text_to_speech_bytes(text, voice=None):
+    """
+    文字转语音（异步），直接返回内存中的 mp3 数据
+    
+    Args:
+        text: 文本内容
+        voice: 音色名称
+        
+    Returns:
+        bytes: mp3 音频数据
+    """
     if voice is None:
         # 自动检测语种
         language, _ = langid.classify(text)
         voice = LANGUAGE_SPEAKER_MAP.get(language, DEFAULT_VOICE)
     
-    output_file = tempfile.mktemp(suffix=".mp3")
-    
     try:
         communicate = edge_tts.Communicate(text, voice)
-        await communicate.save(output_file)
-        return output_file
+        chunks = []
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                chunks.append(chunk["data"])
+        return b"".join(chunks)
     except Exception as e:
         print(f"语音合成失败: {e}")
         return None
 
+def save_wav_async(audio_data, output_file, rate=AUDIO_RATE):
+    """
+    后台线程写出 wav 文件（仅用于归档，不阻塞推理）
+    
+    Args:
+        audio_data: int16 PCM 字节或数组
+        output_file: 输出路径
+        rate: 采样率
+        
+    Returns:
+        threading.Thread: 写文件线程
+    """
+    def write():
+        with wave.open(output_file, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(rate)
+            wf.writeframes(bytes(audio_data))
+    
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread
+
 def detect_language_and_get_voice(text):
     """
     检测语种并获取对应音色
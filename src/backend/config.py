@@ -13,6 +13,7 @@ os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 # ========== 路径配置 ==========
 OUTPUT_DIR = "./output"
 VOICEPRINT_DIR = './SpeakerVerification_DIR/enroll_wav/'
+DEFAULT_SPEAKER_NAME = "enroll_0"  # 未指定名称时注册的说话人
 TEMP_AUDIO_DIR = "./Test_QWen2_VL/"
 
 # 确保目录存在
@@ -40,7 +41,13 @@ MODEL_CONFIG = {
         "model_id": "qwen/Qwen2.5-1.5B-Instruct",
         "torch_dtype": "auto",
         "device_map": "auto",
-        "trust_remote_code": True
+        "trust_remote_code": True,
+        "max_batch_size": 8  # 连续批处理解码的最大并发序列数
+    },
+    "tts": {
+        "backend": "edge-tts",  # "edge-tts" 或 "cosyvoice"
+        "cosyvoice_model_dir": "pretrained_models/CosyVoice-300M-SFT",
+        "cosyvoice_spk_id": "中文女"
     }
 }
 
@@ -52,10 +59,19 @@ DEFAULT_SETTINGS = {
     "sv_threshold": 0.35,
     "enable_tts": True,
     "system_prompt": "你叫小千，是一个21岁的畜牧专业的女大学生，性格活泼开朗，说话俏皮简洁，回答问题不会超过50字。",
-    "memory_max_length": 512,
+    "memory_max_length": 512,  # 对话记忆 token 预算
     "max_new_tokens": 512
 }
 
+# ========== 会话记忆配置 ==========
+MEMORY_CONFIG = {
+    "max_sessions": 64,                 # 内存中保留的活跃会话数
+    "max_total_tokens": 64 * 512,       # 内存中所有会话的 token 总上限
+    "spill_path": None,                 # 冷会话落盘的 SQLite 路径（如 os.path.join(OUTPUT_DIR, "chat_sessions.db")），None 则直接丢弃
+}
+
+DEFAULT_SESSION_ID = "default"
+
 # ========== TTS 配置 ==========
 LANGUAGE_SPEAKER_MAP = {
     "ja": "ja-JP-NanamiNeural",
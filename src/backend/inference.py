@@ -5,20 +5,34 @@
 Inference Logic
 """
 
-import os
 import time
-import asyncio
 import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from transformers import DynamicCache
 
 from .models import maya_models
 from .audio_utils import (
     get_audio_duration,
     is_folder_empty,
     check_wake_word,
-    text_to_speech,
-    detect_language_and_get_voice
+    load_audio
+)
+from .speaker import SpeakerRegistry, extract_speaker_embedding
+from .tts_pipeline import (
+    SentenceTTSPipeline,
+    edge_tts_synthesizer,
+    cosyvoice_synthesizer,
+    discard_audio
+)
+from .config import (
+    AUDIO_RATE,
+    VOICEPRINT_DIR,
+    DEFAULT_SPEAKER_NAME,
+    DEFAULT_SETTINGS,
+    MODEL_CONFIG,
+    DEFAULT_SESSION_ID
 )
-from .config import VOICEPRINT_DIR, DEFAULT_SETTINGS
 
 class InferenceEngine:
     """推理引擎类"""
@@ -26,13 +40,19 @@ class InferenceEngine:
     def __init__(self):
         """初始化推理引擎"""
         self.audio_file_count = 0
+        self.last_turn_stats = {}
+        self.speaker_registry = SpeakerRegistry(VOICEPRINT_DIR)
+        # ASR 与声纹验证并行执行
+        self.executor = ThreadPoolExecutor(max_workers=4)
     
-    def register_voiceprint(self, audio_file):
+    def register_voiceprint(self, audio_file, speaker_name=None, threshold=None):
         """
         声纹注册
         
         Args:
             audio_file: 音频文件路径
+            speaker_name: 说话人名称，为空时覆盖默认说话人
+            threshold: 该说话人的验证阈值，None 使用设置中的阈值
             
         Returns:
             str: 注册状态消息
@@ -40,27 +60,60 @@ class InferenceEngine:
         if audio_file is None:
             return "❌ 请先录制音频"
         
+        speaker_name = (speaker_name or "").strip() or DEFAULT_SPEAKER_NAME
+        if not SpeakerRegistry.is_valid_name(speaker_name):
+            return "❌ 说话人名称只能包含字母、数字、下划线或连字符（最多 64 个字符）"
+        
         try:
             duration = get_audio_duration(audio_file)
             
             if duration < 3:
                 return f"❌ 音频时长仅 {duration:.1f} 秒，需要至少 3 秒"
             
+            # 先同步声纹库，避免随后复制进来的音频在同步时被重复提取嵌入
+            if maya_models.is_loaded():
+                self._ensure_speaker_registry()
+            
             # 保存声纹文件
-            enroll_path = os.path.join(VOICEPRINT_DIR, "enroll_0.wav")
+            enroll_path = self.speaker_registry.enroll_path(speaker_name)
             shutil.copy(audio_file, enroll_path)
             
-            return f"✅ 声纹注册成功！音频时长: {duration:.1f} 秒"
+            # 注册时即计算声纹嵌入并增量加入声纹库
+            if maya_models.is_loaded():
+                embedding = extract_speaker_embedding(maya_models.sv_pipeline, enroll_path)
+                self.speaker_registry.add(speaker_name, embedding, threshold)
+            
+            return f"✅ 声纹注册成功！说话人: {speaker_name}，音频时长: {duration:.1f} 秒"
             
         except Exception as e:
             return f"❌ 声纹注册失败: {str(e)}"
     
+    def remove_voiceprint(self, speaker_name):
+        """
+        删除已注册的说话人
+        
+        Args:
+            speaker_name: 说话人名称
+            
+        Returns:
+            str: 删除状态消息
+        """
+        try:
+            self.speaker_registry.remove(speaker_name)
+            return f"✅ 已删除说话人: {speaker_name}"
+        except Exception as e:
+            return f"❌ 删除声纹失败: {str(e)}"
+    
+    def _ensure_speaker_registry(self):
+        """加载声纹库，并同步目录中新增、修改或删除的注册音频"""
+        self.speaker_registry.load(maya_models.sv_pipeline)
+    
     def speech_to_text(self, audio_file):
         """
         语音识别
         
         Args:
-            audio_file: 音频文件路径
+            audio_file: 音频文件路径或 16k 采样的 PCM 数组
             
         Returns:
             str: 识别结果文本
@@ -104,41 +157,201 @@ class InferenceEngine:
     
     def verify_speaker(self, audio_file, threshold=0.35):
         """
-        声纹验证
+        声纹验证（在所有已注册说话人中识别）
         
         Args:
-            audio_file: 音频文件路径
-            threshold: 验证阈值
+            audio_file: 音频文件路径或 16k 采样的 PCM 数组
+            threshold: 默认验证阈值（说话人未单独设置阈值时使用）
             
         Returns:
             tuple: (是否通过, 相似度分数)
         """
+        speaker_name, score = self.identify_speaker(audio_file, threshold)
+        return speaker_name is not None, score
+    
+    def identify_speaker(self, audio_file, threshold=0.35):
+        """
+        说话人识别
+        
+        Args:
+            audio_file: 音频文件路径或 16k 采样的 PCM 数组
+            threshold: 默认验证阈值
+            
+        Returns:
+            tuple: (说话人名称或 None, 相似度分数)
+        """
         if audio_file is None:
-            return False, 0.0
+            return None, 0.0
         
         if not maya_models.is_loaded():
-            return False, 0.0
-        
-        enroll_file = os.path.join(VOICEPRINT_DIR, "enroll_0.wav")
-        if not os.path.exists(enroll_file):
-            return False, 0.0
+            return None, 0.0
         
         try:
-            sv_score = maya_models.sv_pipeline(
-                [enroll_file, audio_file],
-                thr=threshold
-            )
+            self._ensure_speaker_registry()
+            if len(self.speaker_registry) == 0:
+                return None, 0.0
             
-            score = sv_score.get('score', 0.0)
-            result = sv_score.get('text', 'no')
-            
-            return result == "yes", score
+            embedding = extract_speaker_embedding(maya_models.sv_pipeline, audio_file)
+            return self.speaker_registry.identify(embedding, threshold)
                 
         except Exception as e:
             print(f"声纹验证失败: {e}")
-            return False, 0.0
+            return None, 0.0
+    
+    def create_tts_pipeline(self):
+        """
+        按配置的 TTS 后端创建分句合成流水线
+        
+        Returns:
+            SentenceTTSPipeline: 分句合成流水线
+        """
+        if maya_models.tts_model is not None:
+            synthesize = cosyvoice_synthesizer(
+                maya_models.tts_model,
+                MODEL_CONFIG["tts"]["cosyvoice_spk_id"]
+            )
+        else:
+            # voice=None 时按句检测语种选择音色
+            synthesize = edge_tts_synthesizer()
+        return SentenceTTSPipeline(synthesize)
+    
+    def _yield_audio(self, history, audio_chunks):
+        """
+        逐个产出音频块；生成器恢复时前端已读取该块，随即删除临时文件
+        
+        Args:
+            history: 对话历史
+            audio_chunks: 音频块列表或按序产出音频块的迭代器
+            
+        Yields:
+            tuple: (对话历史, 音频块)
+        """
+        pending = iter(audio_chunks)
+        try:
+            for audio_chunk in pending:
+                try:
+                    yield history, audio_chunk
+                finally:
+                    discard_audio(audio_chunk)
+        finally:
+            # 中途断开时删除已取出但未产出的音频块（迭代器中的由流水线 close 清理）
+            if isinstance(audio_chunks, list):
+                for audio_chunk in pending:
+                    discard_audio(audio_chunk)
+    
+    @staticmethod
+    def _finish_prefix_cache(prefix_cache, request):
+        """
+        请求结束回调（解码线程）：完整生成时保存本轮 KV，随后释放前缀缓存锁
+        
+        Args:
+            prefix_cache: 会话前缀 KV 缓存
+            request: 已结束的请求
+        """
+        try:
+            if request.error is None and not request.cancelled and request.final_cache is not None:
+                prefix_cache.update(
+                    request.context_ids,
+                    DynamicCache.from_legacy_cache(request.final_cache)
+                )
+        finally:
+            prefix_cache.lock.release()
     
-    def chat_respond(self, message, history, audio_input, settings):
+    def stream_generate(self, model_inputs, max_new_tokens, prefix_cache=None, system_prompt=None):
+        """
+        增量解码：请求提交给连续批处理调度器，按 token 产出累计文本
+        
+        Args:
+            model_inputs: 分词后的模型输入
+            max_new_tokens: 最大生成 token 数
+            prefix_cache: 会话前缀 KV 缓存，命中部分跳过预填充
+            system_prompt: 本轮系统提示词（变化时丢弃前缀缓存）
+            
+        Yields:
+            str: 当前已生成的回复文本
+        """
+        # 同一会话并发时只有一个请求能复用缓存，其余走完整预填充
+        use_cache = prefix_cache is not None and prefix_cache.lock.acquire(blocking=False)
+        prefix_length = 0
+        past_key_values = None
+        
+        start_time = time.time()
+        first_token_time = None
+        request = None
+        try:
+            try:
+                if use_cache:
+                    past_key_values, prefix_length = prefix_cache.prepare(
+                        model_inputs.input_ids, system_prompt
+                    )
+                # 交给调度器与其他会话的请求合批解码
+                request = maya_models.llm_scheduler.submit(
+                    model_inputs.input_ids,
+                    max_new_tokens,
+                    past_key_values=past_key_values,
+                    prefix_length=prefix_length,
+                )
+            except BaseException:
+                if use_cache:
+                    prefix_cache.lock.release()
+                raise
+            if use_cache:
+                # 解码线程用完 KV 缓存后才保存本轮缓存并释放锁，
+                # 客户端中途断开时也不会有其他请求在调度器仍使用缓存时拿到它
+                request.add_done_callback(
+                    lambda finished: self._finish_prefix_cache(prefix_cache, finished)
+                )
+            
+            # 增量解码：只解码上次输出位置之后的 token，并带上前一段 token 作为上下文
+            # （保证空格、多字节字符与整体解码一致），避免每个 token 都从头解码
+            output_text = ""
+            prefix_offset = 0
+            read_offset = 0
+            for _ in request:
+                generated_ids = request.generated_ids
+                prefix_text = maya_models.llm_tokenizer.decode(
+                    generated_ids[prefix_offset:read_offset], skip_special_tokens=True
+                )
+                text = maya_models.llm_tokenizer.decode(
+                    generated_ids[prefix_offset:], skip_special_tokens=True
+                )
+                # 多字节字符未解码完整时等待后续 token
+                if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+                    continue
+                output_text += text[len(prefix_text):]
+                prefix_offset = read_offset
+                read_offset = len(generated_ids)
+                if first_token_time is None:
+                    first_token_time = time.time()
+                yield output_text
+        finally:
+            # 客户端断开时让调度器在下一个 token 边界移除该序列
+            if request is not None and request.finish_time is None:
+                request.cancel()
+        
+        # 记录本轮首字延迟与生成速度
+        end_time = time.time()
+        prompt_len = model_inputs.input_ids.shape[1]
+        num_tokens = len(request.generated_ids)
+        decode_time = end_time - (first_token_time or end_time)
+        self.last_turn_stats = {
+            "ttft": (first_token_time or end_time) - start_time,
+            "total_time": end_time - start_time,
+            "num_tokens": num_tokens,
+            "tokens_per_sec": num_tokens / decode_time if decode_time > 0 else 0.0,
+            "prompt_tokens": prompt_len,
+            "cached_prefix_tokens": prefix_length,
+            "queue_wait": request.queue_wait,
+        }
+        print(
+            f"LLM 排队 {request.queue_wait:.3f}s, "
+            f"首字延迟: {self.last_turn_stats['ttft']:.3f}s, "
+            f"前缀缓存命中 {prefix_length}/{prompt_len} tokens, "
+            f"生成 {num_tokens} tokens, "
+            f"速度: {self.last_turn_stats['tokens_per_sec']:.1f} tokens/s"
+        )
+    
+    def chat_respond(self, message, history, audio_input, settings, session_id=DEFAULT_SESSION_ID):
         """
         主对话函数（流式输出）
         
@@ -147,6 +360,7 @@ class InferenceEngine:
             history: 对话历史
             audio_input: 语音输入
             settings: 设置字典
+            session_id: 会话 ID，不同会话的记忆相互隔离
             
         Yields:
             tuple: (更新后的历史, 音频输出)
@@ -156,13 +370,34 @@ class InferenceEngine:
             return
         
         # 1. 处理输入（文字或语音）
+        # 音频只解码一次，ASR 与声纹验证在线程池中并行
         user_text = message
+        sv_future = None
+        audio_data = None
         if audio_input is not None:
-            asr_text = self.speech_to_text(audio_input)
+            try:
+                audio_data = load_audio(audio_input, AUDIO_RATE)
+            except Exception:
+                # 与语音识别失败时的处理一致：记录错误，按无识别结果继续
+                import traceback
+                error_details = traceback.format_exc()
+                print(f"语音识别失败:\n{error_details}")
+                # 无法解码的音频不能通过声纹验证
+                if settings.get("enable_sv", False):
+                    sv_future = Future()
+                    sv_future.set_result((False, 0.0))
+        if audio_data is not None:
+            asr_future = self.executor.submit(self.speech_to_text, audio_data)
+            if settings.get("enable_sv", False):
+                sv_threshold = settings.get("sv_threshold", 0.35)
+                sv_future = self.executor.submit(self.verify_speaker, audio_data, sv_threshold)
+            asr_text = asr_future.result()
             if asr_text:
                 user_text = asr_text
         
         if not user_text or user_text.strip() == "":
+            if sv_future is not None:
+                sv_future.cancel()
             yield history, None
             return
         
@@ -170,19 +405,20 @@ class InferenceEngine:
         history = history + [(user_text, None)]
         yield history, None
         
-        # 2. 关键词唤醒检测
+        # 2. 关键词唤醒检测（ASR 完成即可判断，无需等待声纹验证）
         if settings.get("enable_kws", False):
             wake_word = settings.get("wake_word", "yaya")
             if not check_wake_word(user_text, wake_word):
+                if sv_future is not None:
+                    sv_future.cancel()
                 error_msg = f"⚠️ 未检测到唤醒词「{wake_word}」"
                 history[-1] = (user_text, error_msg)
                 yield history, None
                 return
         
         # 3. 声纹验证
-        if settings.get("enable_sv", False) and audio_input is not None:
-            sv_threshold = settings.get("sv_threshold", 0.35)
-            sv_pass, sv_score = self.verify_speaker(audio_input, sv_threshold)
+        if sv_future is not None:
+            sv_pass, sv_score = sv_future.result()
             if not sv_pass:
                 error_msg = f"⚠️ 声纹验证失败 (相似度: {sv_score:.2f})"
                 history[-1] = (user_text, error_msg)
@@ -190,15 +426,18 @@ class InferenceEngine:
                 return
         
         # 4. 大语言模型推理
+        # 生成期间占用会话记忆，防止被淘汰后并发请求重建出另一份记忆
+        memory = None
+        tts_pipeline = None
         try:
-            context = maya_models.memory.get_context()
-            prompt_with_context = f"{context}\nUser: {user_text}\n" if context else user_text
-            
+            memory = maya_models.checkout_memory(session_id)
             system_prompt = settings.get("system_prompt", DEFAULT_SETTINGS["system_prompt"])
             
+            # 历史按轮次展开为多轮消息，系统提示词和历史轮次构成稳定前缀
             messages = [
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt_with_context},
+                *memory.get_messages(),
+                {"role": "user", "content": user_text},
             ]
             
             text = maya_models.llm_tokenizer.apply_chat_template(
@@ -213,45 +452,51 @@ class InferenceEngine:
             
             max_new_tokens = settings.get("max_new_tokens", DEFAULT_SETTINGS["max_new_tokens"])
             
-            generated_ids = maya_models.llm_model.generate(
-                **model_inputs,
-                max_new_tokens=max_new_tokens,
-            )
-            
-            generated_ids = [
-                output_ids[len(input_ids):]
-                for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-            ]
-            
-            output_text = maya_models.llm_tokenizer.batch_decode(
-                generated_ids, skip_special_tokens=True
-            )[0]
+            # 边生成边分句合成：每凑够一句即送入 TTS 队列
+            if settings.get("enable_tts", True):
+                tts_pipeline = self.create_tts_pipeline()
             
             # 流式显示回复
+            output_text = ""
             history[-1] = (user_text, "")
-            for i in range(0, len(output_text), 2):
-                history[-1] = (user_text, output_text[:i+2])
-                yield history, None
-                time.sleep(0.02)
+            for output_text in self.stream_generate(
+                model_inputs,
+                max_new_tokens,
+                prefix_cache=memory.prefix_cache,
+                system_prompt=system_prompt,
+            ):
+                history[-1] = (user_text, output_text)
+                if tts_pipeline is None:
+                    yield history, None
+                    continue
+                tts_pipeline.feed(output_text)
+                audio_chunks = tts_pipeline.ready_chunks()
+                if not audio_chunks:
+                    yield history, None
+                yield from self._yield_audio(history, audio_chunks)
             
             history[-1] = (user_text, output_text)
             
             # 更新记忆
-            maya_models.memory.add_to_history(user_text, output_text)
+            memory.add_to_history(user_text, output_text)
             
-            # 5. 语音合成
-            audio_output = None
-            if settings.get("enable_tts", True):
-                language, voice = detect_language_and_get_voice(output_text)
-                self.audio_file_count += 1
-                audio_output = asyncio.run(text_to_speech(output_text, voice))
+            # 5. 输出剩余语音块
+            if tts_pipeline is None:
+                yield history, None
+                return
             
-            yield history, audio_output
+            self.audio_file_count += 1
+            yield from self._yield_audio(history, tts_pipeline.remaining_chunks())
             
         except Exception as e:
             error_msg = f"❌ 出错了: {str(e)}"
             history[-1] = (user_text, error_msg)
             yield history, None
+        finally:
+            if tts_pipeline is not None:
+                tts_pipeline.close()
+            if memory is not None:
+                maya_models.release_memory(session_id)
 
 # 创建全局推理引擎实例
 inference_engine = InferenceEngine()
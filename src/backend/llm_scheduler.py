@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 连续批处理调度器
+Continuous-Batching LLM Scheduler
+"""
+
+import threading
+import time
+import traceback
+from queue import Queue, Empty
+
+import torch
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+# token 队列结束标记
+_DONE = object()
+
+class ChatRequest:
+    """单个对话请求：调度器向其 token 队列推送生成结果"""
+
+    def __init__(self, input_ids, max_new_tokens, past_key_values=None, prefix_length=0):
+        """
+        初始化请求
+
+        Args:
+            input_ids: 完整输入 token (1, L)
+            max_new_tokens: 最大生成 token 数
+            past_key_values: 已命中的前缀 KV 缓存
+            prefix_length: 前缀缓存覆盖的 token 数
+        """
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.past_key_values = past_key_values
+        self.prefix_length = prefix_length
+        self.generated_ids = []
+        self.context_ids = input_ids[0].tolist()
+        # 结束后保留的本序列 KV（去掉批内左填充），用于更新前缀缓存
+        self.final_cache = None
+        self.error = None
+        self.cancelled = False
+        self.submit_time = time.time()
+        self.admit_time = None
+        self.finish_time = None
+        self._tokens = Queue()
+        self._done_callbacks = []
+        self._done_lock = threading.Lock()
+
+    @property
+    def queue_wait(self):
+        """排队等待时长（秒）"""
+        if self.admit_time is None:
+            return time.time() - self.submit_time
+        return self.admit_time - self.submit_time
+
+    def cancel(self):
+        """取消请求，调度器在下一个 token 边界移除该序列"""
+        self.cancelled = True
+
+    def add_done_callback(self, fn):
+        """
+        注册结束回调：调度器不再使用该请求的任何状态后，在解码线程中调用 fn(request)；
+        请求已结束时立即在当前线程调用
+
+        Args:
+            fn: 回调函数
+        """
+        with self._done_lock:
+            if self.finish_time is None:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def __iter__(self):
+        """
+        按生成顺序产出 token ID
+
+        Yields:
+            int: token ID
+        """
+        while True:
+            token = self._tokens.get()
+            if token is _DONE:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+    def _emit(self, token_id):
+        self.generated_ids.append(token_id)
+        self.context_ids.append(token_id)
+        self._tokens.put(token_id)
+
+    def _finish(self, error=None):
+        with self._done_lock:
+            self.error = error
+            self.finish_time = time.time()
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        # 回调先于结束标记执行，消费者迭代结束时回调已完成
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                print(f"请求结束回调失败:\n{traceback.format_exc()}")
+        self._tokens.put(_DONE)
+
+class LLMScheduler:
+    """连续批处理调度器：等待中的请求在 token 边界加入解码批，结束的序列随时移出"""
+
+    def __init__(self, model, max_batch_size=8):
+        """
+        初始化调度器并启动解码线程
+
+        Args:
+            model: 因果语言模型
+            max_batch_size: 解码批最大序列数
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        generation_config = model.generation_config
+        eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id or [])
+        self.do_sample = bool(generation_config.do_sample)
+        self.logits_processors = self._build_logits_processors(generation_config)
+
+        self._pending = Queue()
+        self._active = []
+        # 批内状态：各层 (key, value) 形状 (B, H, T, D)，序列右对齐、左侧填充
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+        self._positions = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _build_logits_processors(self, generation_config):
+        """按模型默认生成配置构造 logits 处理器"""
+        processors = LogitsProcessorList()
+        repetition_penalty = generation_config.repetition_penalty
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if self.do_sample:
+            if generation_config.temperature is not None and generation_config.temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(generation_config.temperature))
+            if generation_config.top_k:
+                processors.append(TopKLogitsWarper(generation_config.top_k))
+            if generation_config.top_p is not None and generation_config.top_p < 1.0:
+                processors.append(TopPLogitsWarper(generation_config.top_p))
+        return processors
+
+    def submit(self, input_ids, max_new_tokens, past_key_values=None, prefix_length=0):
+        """
+        提交对话请求
+
+        Args:
+            input_ids: 完整输入 token (1, L)
+            max_new_tokens: 最大生成 token 数
+            past_key_values: 已命中的前缀 KV 缓存
+            prefix_length: 前缀缓存覆盖的 token 数
+
+        Returns:
+            ChatRequest: 可迭代获取生成 token 的请求对象
+        """
+        request = ChatRequest(input_ids, max_new_tokens, past_key_values, prefix_length)
+        self._pending.put(request)
+        return request
+
+    @property
+    def num_active(self):
+        """当前解码批中的序列数"""
+        return len(self._active)
+
+    @property
+    def num_pending(self):
+        """等待加入解码批的请求数"""
+        return self._pending.qsize()
+
+    def _run(self):
+        """解码主循环"""
+        while True:
+            # 本轮新加入的请求，合并失败时可能尚未进入 _active
+            admitted = []
+            try:
+                if not self._active:
+                    # 空闲时阻塞等待新请求
+                    request = self._pending.get()
+                    admitted.append(request)
+                    self._admit(request)
+                while len(self._active) < self.max_batch_size:
+                    try:
+                        request = self._pending.get_nowait()
+                    except Empty:
+                        break
+                    admitted.append(request)
+                    self._admit(request)
+                if self._active:
+                    self._decode_step()
+            except Exception as e:
+                # 任何异常都只结束受影响的请求并清空批状态，解码线程继续服务后续请求
+                print(f"批量解码失败:\n{traceback.format_exc()}")
+                for request in self._active + admitted:
+                    if request.finish_time is None:
+                        request._finish(e)
+                self._reset_batch()
+
+    @torch.no_grad()
+    def _admit(self, request):
+        """预填充新请求并并入解码批"""
+        request.admit_time = time.time()
+        if request.cancelled:
+            request._finish()
+            return
+        try:
+            input_ids = request.input_ids.to(self.model.device)
+            past_key_values = request.past_key_values
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+            outputs = self.model(
+                input_ids=input_ids[:, request.prefix_length:],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            token_id = self._sample(outputs.logits[:, -1, :], [request])[0]
+        except Exception as e:
+            print(f"请求预填充失败:\n{traceback.format_exc()}")
+            request._finish(e)
+            return
+
+        request.past_key_values = None
+        request._emit(token_id)
+        row_cache = outputs.past_key_values.to_legacy_cache()
+        row_length = row_cache[0][0].shape[2]
+        self._merge_row(request, row_cache, row_length, token_id)
+        if self._is_finished(request, token_id):
+            self._remove_rows([len(self._active) - 1])
+
+    def _merge_row(self, request, row_cache, row_length, token_id):
+        """将单序列 KV 左填充对齐后拼入批内缓存"""
+        device = self.model.device
+        row_mask = torch.ones(1, row_length, dtype=torch.long, device=device)
+        row_token = torch.tensor([[token_id]], dtype=torch.long, device=device)
+        row_position = torch.tensor([row_length], dtype=torch.long, device=device)
+        if self._cache is None:
+            self._cache = row_cache
+            self._attention_mask = row_mask
+            self._next_tokens = row_token
+            self._positions = row_position
+            self._active = [request]
+            return
+
+        batch_length = self._attention_mask.shape[1]
+        total_length = max(batch_length, row_length)
+        self._cache = tuple(
+            (
+                torch.cat([self._left_pad(k, total_length), self._left_pad(rk, total_length)], dim=0),
+                torch.cat([self._left_pad(v, total_length), self._left_pad(rv, total_length)], dim=0),
+            )
+            for (k, v), (rk, rv) in zip(self._cache, row_cache)
+        )
+        self._attention_mask = torch.cat([
+            self._left_pad(self._attention_mask, total_length),
+            self._left_pad(row_mask, total_length),
+        ], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, row_token], dim=0)
+        self._positions = torch.cat([self._positions, row_position], dim=0)
+        self._active.append(request)
+
+    @staticmethod
+    def _left_pad(tensor, length):
+        """在序列维度（KV 为 dim=2，mask 为 dim=1）左侧补零到指定长度"""
+        seq_dim = 2 if tensor.dim() == 4 else 1
+        pad_length = length - tensor.shape[seq_dim]
+        if pad_length <= 0:
+            return tensor
+        pad_shape = list(tensor.shape)
+        pad_shape[seq_dim] = pad_length
+        return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=seq_dim)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """整批前向一个 token，并移出已结束的序列"""
+        attention_mask = torch.cat([
+            self._attention_mask,
+            self._attention_mask.new_ones(self._attention_mask.shape[0], 1),
+        ], dim=1)
+        outputs = self.model(
+            input_ids=self._next_tokens,
+            attention_mask=attention_mask,
+            position_ids=self._positions.unsqueeze(1),
+            past_key_values=DynamicCache.from_legacy_cache(self._cache),
+            use_cache=True,
+        )
+        self._cache = outputs.past_key_values.to_legacy_cache()
+        self._attention_mask = attention_mask
+        self._positions = self._positions + 1
+
+        token_ids = self._sample(outputs.logits[:, -1, :], self._active)
+        self._next_tokens = torch.tensor(token_ids, dtype=torch.long, device=self.model.device).unsqueeze(1)
+        finished_rows = []
+        for row, (request, token_id) in enumerate(zip(self._active, token_ids)):
+            if request.cancelled:
+                finished_rows.append(row)
+                continue
+            request._emit(token_id)
+            if self._is_finished(request, token_id):
+                finished_rows.append(row)
+        if finished_rows:
+            self._remove_rows(finished_rows)
+
+    def _sample(self, logits, requests):
+        """按模型生成配置逐行采样下一个 token"""
+        # 重复惩罚需要各行上下文，短行用自身首个 token 补齐，不会引入额外惩罚
+        max_length = max(len(request.context_ids) for request in requests)
+        context_ids = torch.tensor(
+            [
+                [request.context_ids[0]] * (max_length - len(request.context_ids)) + request.context_ids
+                for request in requests
+            ],
+            dtype=torch.long,
+            device=logits.device,
+        )
+        scores = self.logits_processors(context_ids, logits.float())
+        if self.do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        return next_tokens.tolist()
+
+    def _is_finished(self, request, token_id):
+        return token_id in self.eos_token_ids or len(request.generated_ids) >= request.max_new_tokens
+
+    def _remove_rows(self, rows):
+        """移出已结束的序列，保存其 KV 并收紧左侧公共填充"""
+        total_length = self._attention_mask.shape[1]
+        removed_rows = set(rows)
+        for row in rows:
+            request = self._active[row]
+            # 最后一个采样 token 尚未前向，缓存长度等于已输入的真实 token 数
+            row_length = int(self._positions[row])
+            # 拷贝出本行，切片视图会让前缀缓存一直持有整个批的 KV
+            request.final_cache = tuple(
+                (
+                    k[row:row + 1, :, total_length - row_length:].clone(),
+                    v[row:row + 1, :, total_length - row_length:].clone(),
+                )
+                for k, v in self._cache
+            )
+            request._finish()
+
+        keep_rows = [row for row in range(len(self._active)) if row not in removed_rows]
+        if not keep_rows:
+            self._reset_batch()
+            return
+        index = torch.tensor(keep_rows, dtype=torch.long, device=self._attention_mask.device)
+        self._active = [self._active[row] for row in keep_rows]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # 剩余序列都不需要的左侧填充列直接裁掉
+        trim = total_length - int(self._positions.max())
+        self._attention_mask = attention_mask[:, trim:]
+        self._cache = tuple(
+            (k.index_select(0, index)[:, :, trim:], v.index_select(0, index)[:, :, trim:])
+            for k, v in self._cache
+        )
+
+    def _reset_batch(self):
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+        self._positions = None
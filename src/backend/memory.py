@@ -5,30 +5,103 @@
 Chat Memory Management
 """
 
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .prefix_cache import PrefixKVCache
+
+# 每条消息在对话模板中的额外开销（<|im_start|>role\n ... <|im_end|>\n）
+MESSAGE_TOKEN_OVERHEAD = 5
+
 class ChatMemory:
-    """对话记忆类"""
+    """对话记忆类（按 token 预算整轮淘汰）"""
     
-    def __init__(self, max_length=2048):
+    def __init__(self, max_length=2048, tokenizer=None):
         """
         初始化对话记忆
         
         Args:
-            max_length: 最大记忆长度
+            max_length: 最大记忆长度（token 数）
+            tokenizer: LLM 分词器，未设置时按字符数估算
         """
-        self.history = []
         self.max_length = max_length
-
+        self.tokenizer = tokenizer
+        # 每轮: (用户输入, 模型回复, token 数)
+        self.turns = deque()
+        self.total_tokens = 0
+        self._messages = deque()
+        # 每轮渲染后的文本只生成一次，拼接结果缓存到下次增删轮次
+        self._rendered = deque()
+        self._context = ""
+        self.prefix_cache = PrefixKVCache()
+    
+    def count_tokens(self, text):
+        """
+        统计文本 token 数
+        
+        Args:
+            text: 文本
+        
+        Returns:
+            int: token 数
+        """
+        if self.tokenizer is None:
+            return len(text)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+    
     def add_to_history(self, user_input, model_response):
         """
-        添加对话到历史记录
+        添加对话到历史记录，超出 token 预算时从最早的轮次开始整轮淘汰
         
         Args:
             user_input: 用户输入
             model_response: 模型回复
         """
-        self.history.append(f"User: {user_input}")
-        self.history.append(f"Assistant: {model_response}")
-
+        num_tokens = (
+            self.count_tokens(user_input)
+            + self.count_tokens(model_response)
+            + 2 * MESSAGE_TOKEN_OVERHEAD
+        )
+        self._append_turn(user_input, model_response, num_tokens)
+    
+    def load_turns(self, turns):
+        """
+        恢复已记录 token 数的历史轮次（不重新分词）
+        
+        Args:
+            turns: [(用户输入, 模型回复, token 数), ...]
+        """
+        for user_input, model_response, num_tokens in turns:
+            self._append_turn(user_input, model_response, num_tokens)
+    
+    def _append_turn(self, user_input, model_response, num_tokens):
+        """追加一轮对话并按预算淘汰"""
+        self.turns.append((user_input, model_response, num_tokens))
+        self.total_tokens += num_tokens
+        self._messages.append({"role": "user", "content": user_input})
+        self._messages.append({"role": "assistant", "content": model_response})
+        self._rendered.append(self._format_turn(user_input, model_response))
+        self._context = None
+        
+        while self.turns and self.total_tokens > self.max_length:
+            self._evict_oldest()
+    
+    def _evict_oldest(self):
+        """淘汰最早的一轮对话"""
+        user_input, model_response, num_tokens = self.turns.popleft()
+        self.total_tokens -= num_tokens
+        self._messages.popleft()
+        self._messages.popleft()
+        self._rendered.popleft()
+        self._context = None
+    
+    @staticmethod
+    def _format_turn(user_input, model_response):
+        return f"User: {user_input}\nAssistant: {model_response}"
+    
     def get_context(self):
         """
         获取拼接后的对话上下文
@@ -36,15 +109,27 @@ class ChatMemory:
         Returns:
             str: 对话上下文
         """
-        context = "\n".join(self.history)
-        # 截断上下文，使其不超过 max_length
-        if len(context) > self.max_length:
-            context = context[-self.max_length:]
-        return context
+        if self._context is None:
+            self._context = "\n".join(self._rendered)
+        return self._context
+    
+    def get_messages(self):
+        """
+        获取按轮次组织的对话消息（整轮淘汰，保证前缀稳定可复用 KV 缓存）
+        
+        Returns:
+            list: [{"role": ..., "content": ...}, ...]
+        """
+        return list(self._messages)
     
     def clear(self):
         """清空对话历史"""
-        self.history = []
+        self.turns.clear()
+        self.total_tokens = 0
+        self._messages.clear()
+        self._rendered.clear()
+        self._context = ""
+        self.prefix_cache.reset()
     
     def get_history_list(self):
         """
@@ -53,11 +138,183 @@ class ChatMemory:
         Returns:
             list: [(user_msg, bot_msg), ...]
         """
-        result = []
-        for i in range(0, len(self.history), 2):
-            if i + 1 < len(self.history):
-                user = self.history[i].replace("User: ", "")
-                assistant = self.history[i+1].replace("Assistant: ", "")
-                result.append((user, assistant))
-        return result
+        return [(user, assistant) for user, assistant, _ in self.turns]
 
+class SessionMemoryStore:
+    """多会话记忆存储：按会话隔离，LRU 淘汰空闲会话（使用中的会话不淘汰），可将冷会话落盘到 SQLite"""
+    
+    def __init__(self, max_length=512, max_sessions=64, max_total_tokens=None, spill_path=None):
+        """
+        初始化会话记忆存储
+        
+        Args:
+            max_length: 单个会话的 token 预算
+            max_sessions: 内存中最多保留的会话数
+            max_total_tokens: 内存中所有会话的 token 总上限，None 表示不限制
+            spill_path: 冷会话落盘的 SQLite 文件路径，None 表示直接丢弃
+        """
+        self.max_length = max_length
+        self.max_sessions = max_sessions
+        self.max_total_tokens = max_total_tokens
+        self.tokenizer = None
+        self._sessions = OrderedDict()
+        # 正在使用的会话引用计数，被引用的会话不会被淘汰
+        self._pins = {}
+        # 各会话上次统计的 token 数及其总和，避免淘汰时逐个求和
+        self._session_tokens = {}
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, turns TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+    
+    def set_tokenizer(self, tokenizer):
+        """
+        设置 LLM 分词器（同步到已有会话）
+        
+        Args:
+            tokenizer: LLM 分词器
+        """
+        with self._lock:
+            self.tokenizer = tokenizer
+            for memory in self._sessions.values():
+                memory.tokenizer = tokenizer
+    
+    def get(self, session_id):
+        """
+        获取会话记忆，不存在时从磁盘恢复或新建
+        
+        Args:
+            session_id: 会话 ID
+        
+        Returns:
+            ChatMemory: 该会话的记忆
+        """
+        with self._lock:
+            return self._get(session_id)
+    
+    def checkout(self, session_id):
+        """
+        获取会话记忆并标记为使用中，用完后必须调用 release
+        
+        Args:
+            session_id: 会话 ID
+        
+        Returns:
+            ChatMemory: 该会话的记忆
+        """
+        with self._lock:
+            memory = self._get(session_id)
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+            return memory
+    
+    def release(self, session_id):
+        """
+        结束对会话的使用：更新 token 统计，并按上限淘汰空闲会话
+        
+        Args:
+            session_id: 会话 ID
+        """
+        with self._lock:
+            pins = self._pins.get(session_id, 0) - 1
+            if pins > 0:
+                self._pins[session_id] = pins
+            else:
+                self._pins.pop(session_id, None)
+            memory = self._sessions.get(session_id)
+            if memory is not None:
+                self._track_tokens(session_id, memory)
+            self._evict_idle()
+    
+    def _get(self, session_id):
+        """获取或新建会话（需持有锁）"""
+        memory = self._sessions.get(session_id)
+        if memory is not None:
+            self._sessions.move_to_end(session_id)
+            return memory
+        
+        memory = ChatMemory(max_length=self.max_length, tokenizer=self.tokenizer)
+        turns = self._load_spilled(session_id)
+        if turns:
+            memory.load_turns(turns)
+        self._sessions[session_id] = memory
+        self._track_tokens(session_id, memory)
+        self._evict_idle()
+        return memory
+    
+    def _track_tokens(self, session_id, memory):
+        """把会话当前 token 数计入总和"""
+        self._total_tokens += memory.total_tokens - self._session_tokens.get(session_id, 0)
+        self._session_tokens[session_id] = memory.total_tokens
+    
+    def clear(self, session_id):
+        """
+        清空指定会话（包括磁盘中的记录）
+        
+        Args:
+            session_id: 会话 ID
+        """
+        with self._lock:
+            memory = self._sessions.pop(session_id, None)
+            self._total_tokens -= self._session_tokens.pop(session_id, 0)
+            if memory is not None:
+                memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.commit()
+    
+    def clear_all(self):
+        """清空所有会话"""
+        with self._lock:
+            for memory in self._sessions.values():
+                memory.clear()
+            self._sessions.clear()
+            self._session_tokens.clear()
+            self._total_tokens = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions")
+                self._db.commit()
+    
+    def __len__(self):
+        return len(self._sessions)
+    
+    def _evict_idle(self):
+        """淘汰最久未使用的空闲会话，直到满足会话数和 token 总量上限（保留最新会话和使用中的会话）"""
+        for session_id in list(self._sessions)[:-1]:
+            over_sessions = len(self._sessions) > self.max_sessions
+            over_tokens = self.max_total_tokens is not None and self._total_tokens > self.max_total_tokens
+            if not (over_sessions or over_tokens):
+                break
+            if session_id in self._pins:
+                continue
+            memory = self._sessions.pop(session_id)
+            self._total_tokens -= self._session_tokens.pop(session_id, 0)
+            self._spill(session_id, memory)
+    
+    def _spill(self, session_id, memory):
+        """冷会话落盘，KV 缓存随会话对象一起释放"""
+        if self._db is None or not memory.turns:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, turns, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(list(memory.turns), ensure_ascii=False), time.time()),
+        )
+        self._db.commit()
+    
+    def _load_spilled(self, session_id):
+        """从磁盘取回会话并删除落盘记录"""
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT turns FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        self._db.commit()
+        return json.loads(row[0])
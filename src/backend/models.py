@@ -11,8 +11,9 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from modelscope.pipelines import pipeline
 from modelscope import snapshot_download
 
-from .config import MODEL_CONFIG, VOICEPRINT_DIR
-from .memory import ChatMemory
+from .config import MODEL_CONFIG, VOICEPRINT_DIR, DEFAULT_SETTINGS, MEMORY_CONFIG, DEFAULT_SESSION_ID
+from .memory import SessionMemoryStore
+from .llm_scheduler import LLMScheduler
 import os
 
 class MayaModels:
@@ -24,8 +25,15 @@ class MayaModels:
         self.asr_model = None
         self.llm_model = None
         self.llm_tokenizer = None
+        self.llm_scheduler = None
         self.sv_pipeline = None
-        self.memory = ChatMemory(max_length=512)
+        self.tts_model = None
+        self.memory_store = SessionMemoryStore(
+            max_length=DEFAULT_SETTINGS["memory_max_length"],
+            max_sessions=MEMORY_CONFIG["max_sessions"],
+            max_total_tokens=MEMORY_CONFIG["max_total_tokens"],
+            spill_path=MEMORY_CONFIG["spill_path"]
+        )
         
         # 确保声纹目录存在
         os.makedirs(VOICEPRINT_DIR, exist_ok=True)
@@ -99,6 +107,20 @@ class MayaModels:
                 qwen_local_dir,
                 trust_remote_code=MODEL_CONFIG["llm"]["trust_remote_code"]
             )
+            # 记忆按 LLM token 计算预算
+            self.memory_store.set_tokenizer(self.llm_tokenizer)
+
+            # 所有会话的对话请求由调度器合批解码
+            self.llm_scheduler = LLMScheduler(
+                self.llm_model,
+                max_batch_size=MODEL_CONFIG["llm"]["max_batch_size"]
+            )
+
+            # 4. 按配置加载 CosyVoice 语音合成模型
+            if MODEL_CONFIG["tts"]["backend"] == "cosyvoice":
+                yield "📥 正在加载语音合成模型 (CosyVoice)..."
+                from cosyvoice.cli.cosyvoice import CosyVoice
+                self.tts_model = CosyVoice(MODEL_CONFIG["tts"]["cosyvoice_model_dir"])
 
             try:
                 if progress is not None:
@@ -119,9 +141,47 @@ class MayaModels:
         """检查模型是否已加载"""
         return self.models_loaded
     
-    def clear_memory(self):
-        """清空对话记忆"""
-        self.memory.clear()
+    def get_memory(self, session_id=DEFAULT_SESSION_ID):
+        """
+        获取会话记忆
+        
+        Args:
+            session_id: 会话 ID
+            
+        Returns:
+            ChatMemory: 该会话的记忆
+        """
+        return self.memory_store.get(session_id)
+    
+    def checkout_memory(self, session_id=DEFAULT_SESSION_ID):
+        """
+        获取会话记忆并标记为使用中（使用期间不会被淘汰），用完后调用 release_memory
+        
+        Args:
+            session_id: 会话 ID
+            
+        Returns:
+            ChatMemory: 该会话的记忆
+        """
+        return self.memory_store.checkout(session_id)
+    
+    def release_memory(self, session_id=DEFAULT_SESSION_ID):
+        """
+        结束对会话记忆的使用
+        
+        Args:
+            session_id: 会话 ID
+        """
+        self.memory_store.release(session_id)
+    
+    def clear_memory(self, session_id=DEFAULT_SESSION_ID):
+        """
+        清空对话记忆
+        
+        Args:
+            session_id: 会话 ID
+        """
+        self.memory_store.clear(session_id)
 
 # 创建全局模型实例
 maya_models = MayaModels()
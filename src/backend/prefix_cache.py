@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话前缀 KV 缓存
+Prefix KV Cache for System Prompt and Conversation History
+"""
+
+import threading
+
+import torch
+from transformers import DynamicCache
+
+def common_prefix_length(cached_ids, input_ids):
+    """
+    计算两个 token 序列的公共前缀长度
+
+    Args:
+        cached_ids: 已缓存的 token 序列 (1D tensor)
+        input_ids: 新输入的 token 序列 (1D tensor)
+
+    Returns:
+        int: 公共前缀长度
+    """
+    length = min(cached_ids.shape[0], input_ids.shape[0])
+    if length == 0:
+        return 0
+    mismatch = (cached_ids[:length] != input_ids[:length].to(cached_ids.device)).nonzero()
+    if mismatch.numel() == 0:
+        return length
+    return int(mismatch[0, 0])
+
+class PrefixKVCache:
+    """会话级前缀 KV 缓存：保存系统提示词和历史轮次的 past_key_values"""
+
+    def __init__(self):
+        """初始化空缓存"""
+        # 同一会话的并发请求不共享缓存，抢不到锁的请求直接走完整预填充
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, system_prompt=None):
+        """
+        丢弃已缓存的 KV
+
+        Args:
+            system_prompt: 新缓存对应的系统提示词
+        """
+        self.system_prompt = system_prompt
+        self.cached_ids = None
+        self.past_key_values = None
+
+    def prepare(self, input_ids, system_prompt):
+        """
+        为本轮生成准备 KV 缓存：裁剪到与新输入的公共前缀
+
+        Args:
+            input_ids: 本轮完整输入 token (1, L)
+            system_prompt: 本轮系统提示词，变化时丢弃旧缓存
+
+        Returns:
+            tuple: (DynamicCache, 命中的前缀 token 数)
+        """
+        if system_prompt != self.system_prompt:
+            self.reset(system_prompt)
+
+        prefix_length = 0
+        if self.cached_ids is not None:
+            prefix_length = common_prefix_length(self.cached_ids, input_ids[0])
+            # 至少保留一个新 token 做前向，才能得到下一个 token 的 logits
+            prefix_length = min(prefix_length, input_ids.shape[1] - 1)
+
+        if prefix_length > 0:
+            self.past_key_values.crop(prefix_length)
+        else:
+            self.past_key_values = DynamicCache()
+        self.cached_ids = None
+        return self.past_key_values, prefix_length
+
+    def update(self, token_ids, past_key_values):
+        """
+        生成结束后保存本轮 KV 及其对应的 token
+
+        Args:
+            token_ids: 本轮输入加生成的完整 token 序列
+            past_key_values: 本轮结束时该序列的 KV 缓存
+        """
+        self.past_key_values = past_key_values
+        cached_length = past_key_values.get_seq_length()
+        self.cached_ids = torch.tensor(token_ids[:cached_length], dtype=torch.long)
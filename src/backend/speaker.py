@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+声纹嵌入工具
+Speaker Embedding Utilities
+"""
+
+import os
+import re
+import threading
+
+import numpy as np
+
+def extract_speaker_embedding(sv_pipeline, audio):
+    """
+    提取单条音频的 CAM++ 声纹嵌入（L2 归一化）
+
+    Args:
+        sv_pipeline: modelscope 声纹验证 pipeline
+        audio: 音频文件路径或 16k 采样的 PCM 数组
+
+    Returns:
+        np.ndarray: 归一化后的嵌入向量
+    """
+    result = sv_pipeline([audio], output_emb=True)
+    embedding = np.asarray(result['embs'], dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
+
+# 说话人名称只允许字母、数字、下划线和连字符，防止路径穿越
+_SPEAKER_NAME_PATTERN = re.compile(r"[\w\-]{1,64}")
+
+class SpeakerRegistry:
+    """多说话人声纹库：嵌入矩阵一次矩阵-向量乘完成打分，支持按人阈值和增量增删"""
+
+    INDEX_FILE = "speakers.npz"
+
+    def __init__(self, voiceprint_dir):
+        """
+        初始化声纹库
+
+        Args:
+            voiceprint_dir: 注册音频目录，每个说话人一个 <name>.wav
+        """
+        self.voiceprint_dir = voiceprint_dir
+        self.names = []
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        # NaN 表示使用调用方传入的默认阈值
+        self.thresholds = np.zeros(0, dtype=np.float32)
+        # 注册音频的修改时间和大小，任一变化即重新提取嵌入
+        self.mtimes = np.zeros(0, dtype=np.float64)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.loaded = False
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.voiceprint_dir, self.INDEX_FILE)
+
+    @staticmethod
+    def is_valid_name(name):
+        """说话人名称是否合法（1-64 个字母、数字、下划线或连字符）"""
+        return isinstance(name, str) and _SPEAKER_NAME_PATTERN.fullmatch(name) is not None
+
+    def enroll_path(self, name):
+        """
+        说话人注册音频路径
+
+        Raises:
+            ValueError: 名称不合法或路径不在声纹目录内
+        """
+        if not self.is_valid_name(name):
+            raise ValueError(f"非法的说话人名称: {name!r}")
+        root = os.path.realpath(self.voiceprint_dir)
+        path = os.path.realpath(os.path.join(root, f"{name}.wav"))
+        if os.path.dirname(path) != root:
+            raise ValueError(f"非法的说话人名称: {name!r}")
+        return path
+
+    def __len__(self):
+        return len(self.names)
+
+    def _stat(self, name):
+        """注册音频的 (修改时间, 大小)"""
+        stat = os.stat(self.enroll_path(name))
+        return stat.st_mtime, stat.st_size
+
+    def load(self, sv_pipeline):
+        """
+        首次调用时读取已保存的嵌入矩阵，之后每次调用都与目录中的注册音频同步：
+        新增或修改时间/大小变化的音频重新提取嵌入，音频已删除的说话人从库中移除
+
+        Args:
+            sv_pipeline: modelscope 声纹验证 pipeline
+        """
+        with self._lock:
+            if not self.loaded and os.path.exists(self.index_path):
+                index = np.load(self.index_path)
+                self.names = [str(name) for name in index['names']]
+                self.embeddings = index['embeddings'].astype(np.float32)
+                self.thresholds = index['thresholds'].astype(np.float32)
+                self.mtimes = index['mtimes'].astype(np.float64)
+                # 旧版索引没有记录大小，置 -1 使其重新提取一次
+                if 'sizes' in index.files:
+                    self.sizes = index['sizes'].astype(np.int64)
+                else:
+                    self.sizes = np.full(len(self.names), -1, dtype=np.int64)
+
+            changed = False
+            for name in list(self.names):
+                if not self.is_valid_name(name) or not os.path.exists(self.enroll_path(name)):
+                    self._remove(name)
+                    changed = True
+            for entry in sorted(os.listdir(self.voiceprint_dir)):
+                name, ext = os.path.splitext(entry)
+                if ext != ".wav" or not self.is_valid_name(name):
+                    continue
+                mtime, size = self._stat(name)
+                if name in self.names:
+                    row = self.names.index(name)
+                    if self.mtimes[row] == mtime and self.sizes[row] == size:
+                        continue
+                threshold = self.thresholds[self.names.index(name)] if name in self.names else None
+                embedding = extract_speaker_embedding(sv_pipeline, self.enroll_path(name))
+                self._add(name, embedding, threshold, mtime, size)
+                changed = True
+
+            self.loaded = True
+            if changed:
+                self.save()
+
+    def save(self):
+        """保存嵌入矩阵"""
+        with self._lock:
+            np.savez(
+                self.index_path,
+                names=np.array(self.names, dtype=str),
+                embeddings=self.embeddings,
+                thresholds=self.thresholds,
+                mtimes=self.mtimes,
+                sizes=self.sizes,
+            )
+
+    def add(self, name, embedding, threshold=None):
+        """
+        注册或更新说话人（不重算已有说话人的嵌入）
+
+        Args:
+            name: 说话人名称（需已保存 <name>.wav）
+            embedding: 归一化后的嵌入向量
+            threshold: 该说话人的验证阈值，None 使用默认阈值
+        """
+        with self._lock:
+            self._add(name, embedding, threshold, *self._stat(name))
+            self.save()
+
+    def remove(self, name):
+        """
+        删除说话人及其注册音频
+
+        Args:
+            name: 说话人名称
+        """
+        enroll_path = self.enroll_path(name)
+        with self._lock:
+            self._remove(name)
+            if os.path.exists(enroll_path):
+                os.remove(enroll_path)
+            self.save()
+
+    def set_threshold(self, name, threshold):
+        """
+        设置说话人的验证阈值
+
+        Args:
+            name: 说话人名称
+            threshold: 验证阈值，None 使用默认阈值
+        """
+        with self._lock:
+            row = self.names.index(name)
+            self.thresholds[row] = np.nan if threshold is None else threshold
+            self.save()
+
+    def identify(self, embedding, default_threshold=0.35):
+        """
+        识别说话人：一次矩阵-向量乘得到与所有注册人的余弦相似度
+
+        Args:
+            embedding: 归一化后的待验证嵌入
+            default_threshold: 未单独设置阈值的说话人所用阈值
+
+        Returns:
+            tuple: (说话人名称或 None, 最高相似度分数)
+        """
+        with self._lock:
+            if not self.names:
+                return None, 0.0
+            scores = self.embeddings @ embedding
+            thresholds = np.where(np.isnan(self.thresholds), default_threshold, self.thresholds)
+            margins = scores - thresholds
+            best = int(np.argmax(margins))
+            best_score = float(scores[best])
+            if margins[best] < 0:
+                return None, float(scores.max())
+            return self.names[best], best_score
+
+    def _add(self, name, embedding, threshold, mtime, size):
+        threshold = np.nan if threshold is None else threshold
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        if name in self.names:
+            row = self.names.index(name)
+            self.embeddings[row] = embedding[0]
+            self.thresholds[row] = threshold
+            self.mtimes[row] = mtime
+            self.sizes[row] = size
+            return
+        if self.embeddings.shape[0] == 0:
+            self.embeddings = embedding
+        else:
+            self.embeddings = np.concatenate([self.embeddings, embedding], axis=0)
+        self.names.append(name)
+        self.thresholds = np.append(self.thresholds, np.float32(threshold)).astype(np.float32)
+        self.mtimes = np.append(self.mtimes, mtime)
+        self.sizes = np.append(self.sizes, size).astype(np.int64)
+
+    def _remove(self, name):
+        if name not in self.names:
+            return
+        row = self.names.index(name)
+        self.names.pop(row)
+        self.embeddings = np.delete(self.embeddings, row, axis=0)
+        self.thresholds = np.delete(self.thresholds, row)
+        self.mtimes = np.delete(self.mtimes, row)
+        self.sizes = np.delete(self.sizes, row)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分句流水线语音合成
+Sentence-Pipelined Text-to-Speech
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import wave
+from queue import Queue, Empty
+
+import numpy as np
+
+from .audio_utils import text_to_speech, text_to_speech_bytes, detect_language_and_get_voice
+
+# 句末标点：遇到即切句（英文句点需后接空白才切，避免切断小数和缩写）
+SENTENCE_END_CHARS = set("。！？!?；;…\n")
+
+# 队列结束标记
+_DONE = object()
+
+def split_sentences(buffer, min_chars=4):
+    """
+    按句末标点切分文本
+
+    Args:
+        buffer: 待切分文本
+        min_chars: 最短句长，过短的句子与下一句合并
+
+    Returns:
+        tuple: (完整句子列表, 剩余未成句文本)
+    """
+    sentences = []
+    start = 0
+    for i, char in enumerate(buffer):
+        is_end = char in SENTENCE_END_CHARS
+        if char == "." and i + 1 < len(buffer) and buffer[i + 1].isspace():
+            is_end = True
+        if not is_end:
+            continue
+        # 连续标点并入当前句
+        if i + 1 < len(buffer) and buffer[i + 1] in SENTENCE_END_CHARS:
+            continue
+        sentence = buffer[start:i + 1]
+        if len(sentence.strip()) >= min_chars:
+            sentences.append(sentence.strip())
+            start = i + 1
+    return sentences, buffer[start:]
+
+def discard_audio(chunk):
+    """
+    删除已播放或已被消费的临时音频文件（内存中的音频无需处理）
+
+    Args:
+        chunk: 音频块（文件路径或字节）
+    """
+    if isinstance(chunk, str) and os.path.exists(chunk):
+        try:
+            os.remove(chunk)
+        except OSError as e:
+            print(f"删除临时音频失败: {e}")
+
+class SentenceTTSPipeline:
+    """分句语音合成流水线：LLM 流式输出一句，立即送入 TTS 队列"""
+
+    def __init__(self, synthesize, min_chars=4):
+        """
+        初始化流水线并启动 TTS 工作线程
+
+        Args:
+            synthesize: 单句合成函数，输入文本，返回音频（文件路径或字节）
+            min_chars: 最短句长
+        """
+        self.synthesize = synthesize
+        self.min_chars = min_chars
+        self._buffer = ""
+        self._fed_len = 0
+        self._finished = False
+        self._done = False
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._sentence_queue = Queue()
+        self._audio_queue = Queue()
+        self._worker = threading.Thread(target=self._tts_worker, daemon=True)
+        self._worker.start()
+
+    def feed(self, text):
+        """
+        输入 LLM 当前累计输出，切出完整句子送入合成队列
+
+        Args:
+            text: 当前已生成的完整回复文本
+        """
+        if self._finished:
+            return
+        self._buffer += text[self._fed_len:]
+        self._fed_len = len(text)
+        sentences, self._buffer = split_sentences(self._buffer, self.min_chars)
+        for sentence in sentences:
+            self._sentence_queue.put(sentence)
+
+    def finish(self):
+        """LLM 生成结束：送出剩余文本并关闭合成队列"""
+        if self._finished:
+            return
+        self._finished = True
+        rest = self._buffer.strip()
+        self._buffer = ""
+        if rest:
+            self._sentence_queue.put(rest)
+        self._sentence_queue.put(_DONE)
+
+    def ready_chunks(self):
+        """
+        非阻塞地取出已合成的音频块（按句子顺序）
+
+        Returns:
+            list: 音频块列表
+        """
+        chunks = []
+        while not self._done:
+            try:
+                chunk = self._audio_queue.get_nowait()
+            except Empty:
+                break
+            if chunk is _DONE:
+                self._done = True
+                break
+            chunks.append(chunk)
+        return chunks
+
+    def remaining_chunks(self):
+        """
+        阻塞地按顺序产出剩余音频块，直到全部合成完毕
+
+        Yields:
+            音频块
+        """
+        self.finish()
+        while not self._done:
+            chunk = self._audio_queue.get()
+            if chunk is _DONE:
+                self._done = True
+                break
+            yield chunk
+
+    def close(self):
+        """结束流水线并删除尚未被取走的临时音频文件（对话结束或中断时调用）"""
+        with self._close_lock:
+            self._closed = True
+        self.finish()
+        while True:
+            try:
+                chunk = self._audio_queue.get_nowait()
+            except Empty:
+                break
+            if chunk is not _DONE:
+                discard_audio(chunk)
+
+    def _tts_worker(self):
+        """TTS 工作线程：单线程消费保证音频块顺序与句子一致"""
+        while True:
+            sentence = self._sentence_queue.get()
+            if sentence is _DONE:
+                self._audio_queue.put(_DONE)
+                return
+            # 已关闭则不再合成剩余句子
+            if self._closed:
+                continue
+            try:
+                audio = self.synthesize(sentence)
+            except Exception as e:
+                print(f"分句语音合成失败: {e}")
+                audio = None
+            if not audio:
+                continue
+            # 关闭后合成出的音频没人消费，直接删除
+            with self._close_lock:
+                if not self._closed:
+                    self._audio_queue.put(audio)
+                    continue
+            discard_audio(audio)
+
+def _reply_voice(voice):
+    """
+    返回按回复选择音色的函数：voice 为 None 时按首句检测语种，之后整段回复沿用同一音色
+
+    Args:
+        voice: 音色名称
+
+    Returns:
+        callable: 句子 -> 音色名称
+    """
+    def choose(sentence):
+        nonlocal voice
+        if voice is None:
+            _, voice = detect_language_and_get_voice(sentence)
+        return voice
+    return choose
+
+def edge_tts_synthesizer(voice=None):
+    """
+    构造 edge-tts 单句合成函数（每段回复新建一个，保证回复内音色一致）
+
+    Args:
+        voice: 音色名称，None 时按回复首句自动检测语种
+
+    Returns:
+        callable: 文本 -> 临时 mp3 文件路径（消费后用 discard_audio 删除）
+    """
+    choose_voice = _reply_voice(voice)
+    def synthesize(sentence):
+        return asyncio.run(text_to_speech(sentence, choose_voice(sentence)))
+    return synthesize
+
+def edge_tts_bytes_synthesizer(voice=None):
+    """
+    构造 edge-tts 单句合成函数（内存路径，不落盘；每段回复新建一个，保证回复内音色一致）
+
+    Args:
+        voice: 音色名称，None 时按回复首句自动检测语种
+
+    Returns:
+        callable: 文本 -> mp3 字节
+    """
+    choose_voice = _reply_voice(voice)
+    def synthesize(sentence):
+        return asyncio.run(text_to_speech_bytes(sentence, choose_voice(sentence)))
+    return synthesize
+
+def cosyvoice_synthesizer(cosyvoice, spk_id):
+    """
+    构造 CosyVoice SFT 单句合成函数
+
+    Args:
+        cosyvoice: CosyVoice 实例
+        spk_id: 预置说话人
+
+    Returns:
+        callable: 文本 -> 临时 wav 文件路径（消费后用 discard_audio 删除）
+    """
+    def synthesize(sentence):
+        speech = [
+            output['tts_speech'].numpy().flatten()
+            for output in cosyvoice.inference_sft(sentence, spk_id, stream=False)
+        ]
+        if not speech:
+            return None
+        pcm = (np.clip(np.concatenate(speech), -1.0, 1.0) * 32767).astype(np.int16)
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
+            output_file = f.name
+        with wave.open(output_file, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(cosyvoice.sample_rate)
+            wf.writeframes(pcm.tobytes())
+        return output_file
+    return synthesize
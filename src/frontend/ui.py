@@ -101,7 +101,7 @@ def create_claude_ui():
                         )
 
                 # 音频播放区（隐藏式）
-                audio_output = gr.Audio(label="", autoplay=True, visible=False)
+                audio_output = gr.Audio(label="", autoplay=True, streaming=True, visible=False)
 
                 # 状态提示
                 with gr.Row():
@@ -192,6 +192,10 @@ def create_claude_ui():
                                 label="录制音频",
                                 elem_classes="modern-audio"
                             )
+                            speaker_name = gr.Textbox(
+                                label="说话人名称",
+                                placeholder="留空则覆盖默认声纹"
+                            )
                             register_btn = gr.Button(
                                 "✅ 注册声纹",
                                 elem_classes="btn-claude btn-primary btn-full-width",
@@ -270,9 +274,9 @@ def create_claude_ui():
             )
 
         # 清空对话
-        def clear_history():
+        def clear_history(request: gr.Request):
             """清空对话历史"""
-            maya_models.clear_memory()
+            maya_models.clear_memory(request.session_hash)
             return [], None, '<div class="status-badge status-success"><span class="status-dot"></span>对话已清空</div>'
 
         clear_btn.click(
@@ -300,11 +304,11 @@ def create_claude_ui():
         )
 
         # 发送消息 - 优化流式输出
-        def send_message(user_msg, history, audio, settings):
+        def send_message(user_msg, history, audio, settings, request: gr.Request):
             """发送消息并获取回复（流式输出）"""
-            # 调用推理引擎生成器
+            # 调用推理引擎生成器，按浏览器会话隔离记忆
             for updated_history, audio_response in inference_engine.chat_respond(
-                user_msg, history, audio, settings
+                user_msg, history, audio, settings, session_id=request.session_hash
             ):
                 yield updated_history, audio_response
 
@@ -340,9 +344,9 @@ def create_claude_ui():
         )
 
         # 注册声纹
-        def register_voiceprint_with_feedback(audio):
+        def register_voiceprint_with_feedback(audio, name):
             """注册声纹并提供反馈"""
-            result = inference_engine.register_voiceprint(audio)
+            result = inference_engine.register_voiceprint(audio, name)
             if "成功" in result:
                 return result, f'<div class="status-badge status-success">✅ 声纹已注册</div>'
             else:
@@ -350,7 +354,7 @@ def create_claude_ui():
 
         register_btn.click(
             fn=register_voiceprint_with_feedback,
-            inputs=voiceprint_audio,
+            inputs=[voiceprint_audio, speaker_name],
             outputs=[register_status, status_display]
         )
 
@@ -152,6 +152,7 @@ def create_webllm_ui():
                 audio_output = gr.Audio(
                     label="",
                     autoplay=True,
+                    streaming=True,
                     visible=False
                 )
 
@@ -218,6 +219,10 @@ def create_webllm_ui():
                         type="filepath",
                         label="录制音频"
                     )
+                    speaker_name = gr.Textbox(
+                        label="说话人名称",
+                        placeholder="留空则覆盖默认声纹"
+                    )
                     register_btn = gr.Button("✅ 注册声纹", size="sm")
                     register_status = gr.Markdown("")
 
@@ -253,17 +258,18 @@ def create_webllm_ui():
             outputs=load_status
         )
 
-        # 发送消息
-        def send_message(user_msg, history, audio, settings):
+        # 发送消息（每个浏览器会话的每个对话独立记忆）
+        def send_message(user_msg, history, audio, settings, conversation_id, request: gr.Request):
+            session_id = f"{request.session_hash}:{conversation_id}"
             for updated_history, audio_response in inference_engine.chat_respond(
-                user_msg, history, audio, settings
+                user_msg, history, audio, settings, session_id=session_id
             ):
                 yield updated_history, audio_response
 
         # Enter 键发送
         msg.submit(
             fn=send_message,
-            inputs=[msg, chatbot, audio_input, settings_state],
+            inputs=[msg, chatbot, audio_input, settings_state, current_conversation_id],
             outputs=[chatbot, audio_output]
         ).then(
             lambda: ("", None),
@@ -273,7 +279,7 @@ def create_webllm_ui():
         # 点击发送
         send_btn.click(
             fn=send_message,
-            inputs=[msg, chatbot, audio_input, settings_state],
+            inputs=[msg, chatbot, audio_input, settings_state, current_conversation_id],
             outputs=[chatbot, audio_output]
         ).then(
             lambda: ("", None),
@@ -291,12 +297,12 @@ def create_webllm_ui():
         )
 
         # 注册声纹
-        def register_voiceprint(audio):
-            return inference_engine.register_voiceprint(audio)
+        def register_voiceprint(audio, name):
+            return inference_engine.register_voiceprint(audio, name)
 
         register_btn.click(
             fn=register_voiceprint,
-            inputs=voiceprint_audio,
+            inputs=[voiceprint_audio, speaker_name],
             outputs=register_status
         )
 
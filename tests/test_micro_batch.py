@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MicroBatcher 合批测试
+验证并发的同长度调用会合并成一次 run_batch
+"""
+
+import os
+import sys
+import threading
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from cosyvoice.utils.micro_batch import MicroBatcher
+
+
+def _submit_together(batcher, keys):
+    barrier = threading.Barrier(len(keys))
+    results = [None] * len(keys)
+
+    def call(i):
+        barrier.wait()
+        results[i] = batcher.submit(keys[i], i)
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(keys))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_concurrent_same_length_calls_share_one_batch():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(key, items):
+        calls.append((key, list(items)))
+        if items == ['warmup']:
+            started.set()
+            release.wait()
+        return [(key, item) for item in items]
+
+    batcher = MicroBatcher(run_batch, max_batch_size=8, max_wait=0.2)
+
+    # 第一次重叠前单个调用直接内联执行
+    assert batcher.submit(100, 'single') == (100, 'single')
+    assert calls == [(100, ['single'])]
+
+    # 制造一次重叠, 之后的调用都经过收集线程
+    warmup = threading.Thread(target=batcher.submit, args=(100, 'warmup'))
+    warmup.start()
+    started.wait()
+    overlap = threading.Thread(target=batcher.submit, args=(100, 'overlap'))
+    overlap.start()
+    release.set()
+    warmup.join()
+    overlap.join()
+    del calls[:]
+
+    results = _submit_together(batcher, [200, 200])
+    assert results == [(200, 0), (200, 1)]
+    assert len(calls) == 1, calls
+    assert calls[0][0] == 200 and sorted(calls[0][1]) == [0, 1]
+
+    # 不同长度不会被合到同一次调用
+    del calls[:]
+    results = _submit_together(batcher, [200, 300])
+    assert results == [(200, 0), (300, 1)]
+    assert sorted(key for key, _ in calls) == [200, 300]
+
+
+if __name__ == '__main__':
+    test_concurrent_same_length_calls_share_one_batch()
+    print("✅ 并发同长度调用共享一次 run_batch")